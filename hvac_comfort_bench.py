@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for hvac_comfort_lib and hvac_comfort_calc.py on synthetic
+thermostat data.
+
+Each scenario generates thermostat logs with make_hvac_data, writes them as
+raw CSV files (in the labels the label mapping expects) and reports the
+run time, throughput and peak traced memory of the lib functions and of an
+end-to-end run of hvac_comfort_calc.py.
+
+Usage:
+    python hvac_comfort_bench.py                    # default scenarios
+    python hvac_comfort_bench.py --zones 3 --interval 1min --days 90
+    python hvac_comfort_bench.py --save-baseline    # store results as the baseline
+
+Results are compared against the baseline file when it exists, and the
+script exits with status 1 if any time or memory exceeds the baseline by
+more than the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import hvac_comfort_lib as lib
+
+# Raw labels for the synthetic data when no label mapping file is given
+SYNTH_LABEL_MAPPING = {"DateTime": "Timestamp", "HVAC Mode": "op_mode", "Hold Status": "hold_on"}
+for zone in range(0, 8):
+    SYNTH_LABEL_MAPPING.update({
+            "Zone{} Heat Setpoint".format(zone + 1): "heat_sp_{}".format(zone),
+            "Zone{} Cool Setpoint".format(zone + 1): "cool_sp_{}".format(zone),
+            "Zone{} Room Temp".format(zone + 1): "rm_temp_{}".format(zone),
+            "Zone{} Thermostat Mode".format(zone + 1): "ts_mode_{}".format(zone)
+    })
+
+SCENARIOS = {
+        "1zone_1min_30d": dict(nZones=1, interval="1min", days=30),
+        "3zone_1min_30d": dict(nZones=3, interval="1min", days=30),
+        "3zone_5min_90d": dict(nZones=3, interval="5min", days=90),
+        "3zone_1min_30d_busy": dict(nZones=3, interval="1min", days=30, sp_changes_per_day=48, off_fraction=0.8)
+}
+
+BASELINE_FILEPATH = "./bench_baseline.json"
+CALC_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hvac_comfort_calc.py")
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "HVAC_Comfort_Config.xlsx")
+
+
+def make_hvac_data(nZones=3, interval="1min", days=30, sp_changes_per_day=4, off_fraction=0.5,
+                   start="2018-07-01", seed=0):
+    """
+    Generates a synthetic thermostat log in model labels.
+    Args:
+        nZones: number of zones
+        interval: sampling interval, e.g. "1min" or "5min"
+        days: duration of the log
+        sp_changes_per_day: average number of setpoint changes per zone and day
+        off_fraction: fraction of the time the HVAC is off
+        start: first timestamp (UTC)
+        seed: random seed
+    Returns:
+        df: dataframe with Timestamp (UTC), op_mode, hold_on and heat_sp_{},
+            cool_sp_{}, rm_temp_{} and ts_mode_{} for each zone
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    timestamps = pd.date_range(start, start + pd.Timedelta(days=days), freq=interval, inclusive="left")
+    n = len(timestamps)
+    steps_per_day = n / days
+
+    df = pd.DataFrame({"Timestamp": timestamps})
+
+    # HVAC runs in cycles of about 15 minutes, off for off_fraction of them
+    cycle = max(1, int(pd.Timedelta("15min") / pd.Timedelta(interval)))
+    nCycles = n // cycle + 1
+    is_off = np.repeat(rng.random(nCycles) < off_fraction, cycle)[:n]
+    on_mode = np.repeat(rng.choice(["Heat", "Cool"], nCycles, p=[0.3, 0.7]), cycle)[:n]
+    df["op_mode"] = np.where(is_off, "Off", on_mode)
+
+    # Hold is enabled for stretches of about a day
+    hold = np.repeat(rng.random(days + 1) < 0.3, int(np.ceil(steps_per_day)))[:n]
+    df["hold_on"] = hold
+
+    # Daily temperature swing shared by all zones
+    day_phase = np.arange(n) / steps_per_day * 2 * np.pi
+    swing = 2 * np.sin(day_phase)
+
+    for zone in range(0, nZones):
+        # Setpoints change at random times and hold until the next change
+        nChanges = rng.poisson(sp_changes_per_day * days) + 1
+        change_steps = np.sort(rng.integers(0, n, nChanges))
+        change_steps[0] = 0
+        heat = rng.choice(np.arange(62, 73, 0.5), nChanges)
+        cool = heat + rng.choice([3, 4, 5, 6, 8], nChanges)
+        sp_index = np.searchsorted(change_steps, np.arange(n), side="right") - 1
+
+        df["heat_sp_{}".format(zone)] = heat[sp_index]
+        df["cool_sp_{}".format(zone)] = cool[sp_index]
+
+        # Room temperature stays near the band, drifting further when off
+        mid = (heat[sp_index] + cool[sp_index]) / 2
+        noise = rng.normal(0, 1, n) + is_off * rng.normal(0, 1.5, n)
+        df["rm_temp_{}".format(zone)] = np.round((mid + swing + noise) * 2) / 2
+
+        df["ts_mode_{}".format(zone)] = np.where(rng.random(nChanges) < 0.4, "Manual", "Schedule")[sp_index]
+
+    return df
+
+
+def write_hvac_csv(df, filepath, label_mapping=SYNTH_LABEL_MAPPING):
+    """Writes a dataframe from make_hvac_data as a raw CSV using the label mapping's raw labels"""
+    raw_labels = {}
+    for raw_label, label in label_mapping.items():
+        raw_labels.setdefault(label, raw_label)
+
+    df = df.rename(columns=raw_labels)
+    df[raw_labels["Timestamp"]] = df[raw_labels["Timestamp"]].dt.strftime("%Y-%m-%d %H:%M:%S")
+    df.to_csv(filepath, index=False)
+
+
+def write_hvac_months(df, dir_in, rlid, label_mapping=SYNTH_LABEL_MAPPING):
+    """
+    Writes a dataframe from make_hvac_data as one "{rlid}_hvac_{month}.csv"
+    file per month, as hvac_comfort_calc.py expects. Returns the months.
+    """
+    months = []
+    for month, df_month in df.groupby(df["Timestamp"].dt.strftime("%Y-%m")):
+        write_hvac_csv(df_month, "{}{}_hvac_{}.csv".format(dir_in, rlid, month), label_mapping)
+        months.append(month)
+
+    return months
+
+
+def measure(func, args, repeat=3):
+    """Best wall time of repeat calls and the peak traced memory of one more call"""
+    seconds = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(seconds), peak
+
+
+def bench_lib(df, work_dir, label_mapping, repeat):
+    """Benchmarks each lib function on the data in df. Returns {function: (seconds, peak bytes)}"""
+    filepath = os.path.join(work_dir, "bench_hvac.csv")
+    write_hvac_csv(df, filepath, label_mapping)
+
+    df = lib.import_hvac(filepath, label_mapping)
+    max_nZones = len([col for col in df.columns if "rm_temp" in col])
+    comfband_counts, df_1090 = lib.get_comfband_stats(df, max_nZones)
+    savepath = os.path.join(work_dir, "bench_comfbands.html")
+
+    benches = {
+            "import_hvac": (lib.import_hvac, (filepath, label_mapping)),
+            "get_comfortband_counts": (lib.get_comfortband_counts, (df, 0)),
+            "get_all_comfortband_counts": (lib.get_all_comfortband_counts, (df, max_nZones)),
+            "get_rm_temp_counts": (lib.get_rm_temp_counts, (df,)),
+            "get_off_counts": (lib.get_off_counts, (df, 0)),
+            "calculate_temp_1090": (lib.calculate_temp_1090, (df,)),
+            "get_comfband_stats": (lib.get_comfband_stats, (df, max_nZones)),
+            "plot_comfband_bars": (lib.plot_comfband_bars, (comfband_counts, savepath, "Benchmark"))
+    }
+
+    results = {}
+    for name, (func, args) in benches.items():
+        results[name] = measure(func, args, repeat)
+
+    return results
+
+
+def bench_calc(df, work_dir, label_mapping, overrides=None):
+    """
+    Runs hvac_comfort_calc.py on the data in df in a separate process.
+    overrides is a dict of extra config parameters. Returns (seconds, peak bytes).
+    """
+    dir_in = os.path.join(work_dir, "Model_Data") + os.sep
+    results_dir = os.path.join(work_dir, "Model_Output") + os.sep
+    os.makedirs(dir_in, exist_ok=True)
+    os.makedirs(results_dir + "HTML_Subplots", exist_ok=True)
+
+    rlid = "RL00"
+    months = write_hvac_months(df, dir_in, rlid, label_mapping)
+
+    label_mapping_file = os.path.join(work_dir, "label_mapping.xlsx")
+    pd.DataFrame({"Southern_Labels": list(label_mapping), "Model_Labels": list(label_mapping.values())}).to_excel(
+            label_mapping_file, sheet_name="HVAC", index=False)
+
+    # Start from the repo config so new required parameters are picked up
+    config = lib.read_config(CONFIG_FILEPATH)
+    values = {
+            "Label Mapping Filepath": label_mapping_file,
+            "Label Mapping Sheetname": "HVAC",
+            "Model Input Data Dir": dir_in,
+            "Model Output Dir": results_dir,
+            "RLIDs": rlid,
+            "Months": ", ".join(months),
+            "Maximum Number of Zones": len([col for col in df.columns if "rm_temp" in col])
+    }
+    values.update(overrides or {})
+    config = config.set_index("Parameter")
+    for var, value in values.items():
+        config.loc[var, "Value"] = value
+    config.reset_index().to_excel(os.path.join(work_dir, "HVAC_Comfort_Config.xlsx"), index=False)
+
+    # Time one run, then trace the memory of a second run
+    runner = ("import os, sys, json, time, runpy, tracemalloc\n"
+              "sys.path.insert(0, os.path.dirname(sys.argv[1]))\n"
+              "trace = sys.argv[2] == '1'\n"
+              "calc_filepath = sys.argv[1]\n"
+              "sys.argv = [calc_filepath] # the calc script parses its own arguments\n"
+              "if trace: tracemalloc.start()\n"
+              "start = time.perf_counter()\n"
+              "runpy.run_path(calc_filepath, run_name='__main__')\n"
+              "seconds = time.perf_counter() - start\n"
+              "peak = tracemalloc.get_traced_memory()[1] if trace else 0\n"
+              "print('BENCH ' + json.dumps([seconds, peak]))\n")
+
+    results = []
+    for trace in ["0", "1"]:
+        output = subprocess.run([sys.executable, "-c", runner, CALC_FILEPATH, trace], cwd=work_dir,
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError("hvac_comfort_calc.py failed:\n" + output.stderr)
+        line = [l for l in output.stdout.splitlines() if l.startswith("BENCH ")][-1]
+        results.append(json.loads(line[len("BENCH "):]))
+
+    return results[0][0], results[1][1]
+
+
+def compare_baseline(results, baseline, time_threshold, memory_threshold):
+    """Returns a list of messages for the results that regressed from the baseline"""
+    regressions = []
+    for scenario, benches in results.items():
+        for name, result in benches.items():
+            if name not in baseline.get(scenario, {}):
+                continue
+            base = baseline[scenario][name]
+            if result["seconds"] > base["seconds"] * time_threshold:
+                regressions.append("{} {}: {:.3f}s vs baseline {:.3f}s".format(
+                        scenario, name, result["seconds"], base["seconds"]))
+            if result["peak_mb"] > base["peak_mb"] * memory_threshold:
+                regressions.append("{} {}: {:.1f}MB vs baseline {:.1f}MB".format(
+                        scenario, name, result["peak_mb"], base["peak_mb"]))
+
+    return regressions
+
+
+def print_report(results, baseline):
+    print("{:<24} {:<28} {:>10} {:>14} {:>10} {:>9}".format(
+            "Scenario", "Benchmark", "Time [s]", "Rows/s", "Peak [MB]", "vs Base"))
+    for scenario, benches in results.items():
+        for name, result in benches.items():
+            base = baseline.get(scenario, {}).get(name)
+            ratio = "{:.2f}x".format(result["seconds"] / base["seconds"]) if base else ""
+            print("{:<24} {:<28} {:>10.4f} {:>14,.0f} {:>10.1f} {:>9}".format(
+                    scenario, name, result["seconds"], result["rows_per_s"], result["peak_mb"], ratio))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark hvac_comfort_lib on synthetic thermostat data")
+    parser.add_argument("--zones", type=int, help="Run a single scenario with this many zones")
+    parser.add_argument("--interval", default="1min", help="Sampling interval of the single scenario")
+    parser.add_argument("--days", type=int, default=30, help="Duration of the single scenario")
+    parser.add_argument("--sp-changes", type=float, default=4, help="Setpoint changes per zone and day")
+    parser.add_argument("--off-fraction", type=float, default=0.5, help="Fraction of time the HVAC is off")
+    parser.add_argument("--label-mapping", help="Label mapping spreadsheet for the raw labels")
+    parser.add_argument("--sheet", default="HVAC", help="Label mapping sheet name")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the best time is kept")
+    parser.add_argument("--no-calc", action="store_true", help="Skip the end-to-end calc script run")
+    parser.add_argument("--baseline", default=BASELINE_FILEPATH, help="Baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--time-threshold", type=float, default=1.25, help="Allowed time ratio to the baseline")
+    parser.add_argument("--memory-threshold", type=float, default=1.25, help="Allowed memory ratio to the baseline")
+    args = parser.parse_args()
+
+    if args.label_mapping:
+        label_mapping = lib.get_label_mapping(args.label_mapping, args.sheet)
+    else:
+        label_mapping = SYNTH_LABEL_MAPPING
+
+    if args.zones:
+        name = "{}zone_{}_{}d".format(args.zones, args.interval, args.days)
+        scenarios = {name: dict(nZones=args.zones, interval=args.interval, days=args.days,
+                                sp_changes_per_day=args.sp_changes, off_fraction=args.off_fraction)}
+    else:
+        scenarios = SCENARIOS
+
+    results = {}
+    for scenario, params in scenarios.items():
+        print("Benchmarking: {}".format(scenario))
+        df = make_hvac_data(**params)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            benches = bench_lib(df, work_dir, label_mapping, args.repeat)
+            if not args.no_calc:
+                benches["hvac_comfort_calc"] = bench_calc(df, work_dir, label_mapping)
+
+        results[scenario] = {name: {"seconds": seconds, "rows_per_s": len(df) / seconds, "peak_mb": peak / 1024**2}
+                             for name, (seconds, peak) in benches.items()}
+
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        baseline = {}
+
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline: {}".format(args.baseline))
+    else:
+        regressions = compare_baseline(results, baseline, args.time_threshold, args.memory_threshold)
+        for message in regressions:
+            print("REGRESSION " + message)
+        if regressions:
+            sys.exit(1)
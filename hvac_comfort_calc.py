@@ -1,92 +1,325 @@
 
 
+import os
+import sys
+import argparse
 import hvac_comfort_lib as lib
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
-############################################
-# Get Run Configuration 
-config_filepath = "./HVAC_Comfort_Config.xlsx"
-config = pd.read_excel(config_filepath)
+# Bumped when the result saved in task checkpoints changes
+RESULT_VERSION = 2
 
-label_mapping_file = lib.get_val(config, "Label Mapping Filepath")
-label_mapping_sheetname = lib.get_val(config, "Label Mapping Sheetname") 
-dir_in = lib.get_val(config, "Model Input Data Dir")
-results_dir = lib.get_val(config, "Model Output Dir")
-dir_subplots = results_dir + lib.get_val(config, "Subplots Dir")
-rlids = lib.get_values(config, "RLIDs")
-max_nZones = lib.get_val(config, "Maximum Number of Zones")
-comfband_filepath = results_dir + lib.get_val(config, "Results Plots Filename")
-comf1090_filepath = results_dir + lib.get_val(config, "Results Filename")
-months = lib.get_values(config, "Months")
 
-############################################
+def calc_comfband(rlid, month, settings, writer=None):
+    """
+    Calculates the 10/90 stats and plots the comfort band counts for a single
+    RLID and month, or range of months (see lib.get_months). Runs in a worker
+    process when "Workers" is more than 1, so all inputs are passed in
+    through settings instead of module globals.
 
-# Import Label Mapping 
-label_mapping = lib.get_label_mapping(label_mapping_file, label_mapping_sheetname) 
+    When "Checkpoint Dir" is set, a finished task is saved with a fingerprint
+    of its input files and settings, and skipped by later runs until either
+    changes.
 
-# Create Results DataFrames List 
-all_comfbands = []
+    If a lib.AsyncWriter is given, the subplot and checkpoint are written in
+    the background by write_task and this returns as soon as the stats are
+    calculated.
+    Returns:
+        df_1090: 10/90 stats row from calculate_temp_1090 with the RLID added
+        savepath: path of the comfort band subplot, None when "Plot Output" is
+            "none"
+        comfband_counts: counts from get_comfband_stats, for the result sinks
+    """
+    max_nZones = settings["max_nZones"]
+    tz = settings["timezones"].get(rlid, settings["timezone"])
+    dataset = lib.HVACDataset(settings["dir_in"], rlid, lib.get_months(month), settings["label_mapping"],
+                              tz=tz, time_format=settings["time_format"], schema=settings["schema"])
 
-################################################
-# Plot frequency of occurency of room temperatres and setpoint ranges
+    if settings["checkpoint_dir"]:
+        # The subplot's directory and plotly.js mode are outputs of the task too
+        fingerprint = lib.get_fingerprint(dataset.filepaths(), settings["label_mapping"], max_nZones,
+                                          tz, settings["time_format"], settings["schema"], settings["plot"],
+                                          settings["dir_subplots"], settings["include_plotlyjs"], RESULT_VERSION)
+        result = lib.load_checkpoint(settings["checkpoint_dir"], (rlid, month), fingerprint)
+        if result is not None:
+            return result
 
-# Create Output HTML File 
-HTML_comfband = lib.init_HTML(comfband_filepath) 
+    if settings["chunksize"]:
+        # Stream the files, keeping only the running counts in memory
+        stats = lib.ComfortStats(max_nZones)
+        for chunk in dataset.iter_chunks(settings["chunksize"]):
+            stats.update(chunk)
 
-#HTML_comfband = open(comfband_filepath, "w")
-#HTML_comfband.write("<html>\n<head></head>\n<body>\n")
+        comfband_counts, df_1090 = stats.get_comfband_stats()
+    else:
+        df = dataset.read(settings["cache_dir"], settings["cache_size_mb"])
 
-for rlid in rlids:
-    print("Plotting Comfortband: {}".format(rlid))
+        comfband_counts, df_1090 = lib.get_comfband_stats(df, max_nZones)
 
-    for month in months:
+    df_1090["RLID"] = rlid
 
-        hvac_filepath = "{}{}_hvac_{}.csv".format(dir_in, rlid, month)
+    if settings["plot"]:
+        savepath = "{}{}_comfbands_{}.html".format(settings["dir_subplots"], rlid, month.replace(" ", "_"))
+    else:
+        savepath = None
+    fig_title = "{}: {}".format(rlid, month)
 
-        df = lib.import_hvac(hvac_filepath, label_mapping)
+    if settings["checkpoint_dir"]:
+        checkpoint = (settings["checkpoint_dir"], (rlid, month), fingerprint, (df_1090, savepath, comfband_counts), savepath)
+    else:
+        checkpoint = None
 
-        comfband_counts = []
-        off_counts = []
-        for zone in range(0, max_nZones):
-            comfband_counts.append(lib.get_comfortband_counts(df,zone))
+    if writer is None:
+        write_comfband(comfband_counts, savepath, fig_title, settings, checkpoint)
+    else:
+        writer.submit(write_task, rlid, month, comfband_counts, savepath, fig_title, settings, checkpoint)
 
-        off_counts.append(lib.get_off_counts(df,zone))
+    return df_1090, savepath, comfband_counts
 
-        comfband_counts = pd.concat(comfband_counts, axis=1)
 
-        rm_temp_counts = lib.get_rm_temp_counts(df)
+def write_comfband(comfband_counts, savepath, fig_title, settings, checkpoint=None):
+    """
+    Plots the comfort band counts of a task, unless savepath is None, then
+    saves its checkpoint, which is only valid once the subplot exists.
+    """
+    if savepath is not None:
+        with lib.trace_stage("plot_comfband_bars", len(comfband_counts)):
+            lib.plot_comfband_bars(comfband_counts, savepath, fig_title, settings["include_plotlyjs"])
 
-        comfband_counts = comfband_counts.join(rm_temp_counts)
-        comfband_counts = comfband_counts.join(off_counts)
+    if checkpoint is not None:
+        lib.save_checkpoint(*checkpoint)
 
-        df_1090 = lib.calculate_temp_1090(df)
-        df_1090["RLID"] = rlid
 
-        if "df_1090s" not in globals():
-            df_1090s = df_1090
-        else:
-            df_1090s = pd.concat([df_1090s, df_1090])
+def run_task(rlid, month, settings, writer=None):
+    """
+    Runs calc_comfband, recording the stage timings when "Trace File" is set.
+    Returns:
+        result: (df_1090, savepath, comfband_counts) from calc_comfband
+        records: stage records from lib.trace_stage, empty when not tracing
+    """
+    if settings["trace_filepath"]:
+        lib.start_trace(rlid=rlid, month=month)
 
+    try:
+        result = calc_comfband(rlid, month, settings, writer)
+    finally:
+        records = lib.stop_trace()
 
+    return result, records
 
-        for zone in range(0, max_nZones):
-            if zone in comfband_counts:
-                comfband_counts["norm_off_rm_temp_{}".format(zone)] = comfband_counts["off_rm_temp_{}".format(zone)]/comfband_counts["rm_temp_{}".format(zone)]
 
-        savepath = "{}{}_comfbands_{}.html".format(dir_subplots, rlid, month)
-        fig_title = "{}: {}".format(rlid, month)
-        lib.plot_comfband_bars(comfband_counts, savepath, fig_title)
+def write_task(rlid, month, comfband_counts, savepath, fig_title, settings, checkpoint):
+    """
+    Runs write_comfband in a lib.AsyncWriter process, recording the stage
+    timings when "Trace File" is set. Returns the stage records.
+    """
+    if settings["trace_filepath"]:
+        lib.start_trace(rlid=rlid, month=month)
 
-        # Update HTML File
-        HTML_comfband.write('<object data="{}" width="100%" height="400"></object>\n'.format(savepath))
+    try:
+        write_comfband(comfband_counts, savepath, fig_title, settings, checkpoint)
+    finally:
+        records = lib.stop_trace()
 
-    all_comfbands.append(df_1090s.reset_index(drop=True))
-    del df_1090s
+    return records
 
-HTML_comfband.write("</body>\n</html>")
 
-HTML_comfband.close()
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Calculates the comfort band stats of the configured RLIDs and months")
+    parser.add_argument("--shard", default="",
+                        help='run as worker "i/N" of N workers sharing the config\'s "Shard Dir", e.g. "0/4"')
+    parser.add_argument("--reduce", action="store_true",
+                        help='merge the finished "Shard Dir" tasks into the results workbook and HTML index')
+    args = parser.parse_args()
 
-# Export Comfort Band Stats to Excel
-lib.save_xls(all_comfbands, comf1090_filepath)
+    ############################################
+    # Get Run Configuration
+    config_filepath = "./HVAC_Comfort_Config.xlsx"
+    config = lib.read_config(config_filepath)
+
+    label_mapping_file = lib.get_val(config, "Label Mapping Filepath")
+    label_mapping_sheetname = lib.get_val(config, "Label Mapping Sheetname")
+    dir_in = lib.get_val(config, "Model Input Data Dir")
+    results_dir = lib.get_val(config, "Model Output Dir")
+    dir_subplots = results_dir + lib.get_val(config, "Subplots Dir")
+    rlids_file = lib.get_val(config, "RLIDs File", "") # one RLID per line, replaces "RLIDs"
+    rlids = lib.read_rlids(rlids_file) if rlids_file else lib.get_values(config, "RLIDs")
+    max_nZones = lib.get_val(config, "Maximum Number of Zones", 0) or None # None counts every zone in the data
+    comfband_filepath = results_dir + lib.get_val(config, "Results Plots Filename")
+    comf1090_filepath = results_dir + lib.get_val(config, "Results Filename")
+    months = lib.get_values(config, "Months")
+    chunksize = int(lib.get_val(config, "Chunk Size", 0)) # 0 reads each file at once
+    cache_dir = lib.get_val(config, "Cache Dir", "") # "" disables the import cache
+    cache_size_mb = lib.get_val(config, "Cache Size MB", 2048)
+    workers = int(lib.get_val(config, "Workers", 1)) # 1 runs every task in this process
+    timezone = lib.get_val(config, "Timezone", "US/Central")
+    timezones = lib.get_value_mapping(config, "Household Timezones") # e.g. "RL25: US/Eastern"
+    time_format = lib.get_val(config, "Time Format", "") or None # None infers the format
+    compact_dtypes = lib.get_val(config, "Compact Dtypes", 0)
+    checkpoint_dir = lib.get_val(config, "Checkpoint Dir", "") # "" disables checkpoints
+    trace_filepath = lib.get_val(config, "Trace File", "") # "" disables stage timings
+    plot_output = lib.get_val(config, "Plot Output", "standalone") # or "shared", "report", or "none" for stats only
+    plot_workers = int(lib.get_val(config, "Plot Workers", 0)) # 0 plots each task before the next
+    results_formats = [x.strip() for x in lib.get_val(config, "Results Formats", "xlsx").split(",")]
+    shard_dir = lib.get_val(config, "Shard Dir", "") # shared by --shard workers and --reduce
+
+    ############################################
+
+    # Checked before any task is scheduled, including by --shard workers
+    if (max_nZones is None) and any(fmt != "xlsx" for fmt in results_formats):
+        raise ValueError('Results Formats other than xlsx need a "Maximum Number of Zones" for their columns')
+
+    # Import Label Mapping
+    label_mapping = lib.get_label_mapping(label_mapping_file, label_mapping_sheetname)
+
+    if compact_dtypes:
+        schema = lib.get_label_schema(label_mapping_file, label_mapping_sheetname)
+    else:
+        schema = None
+
+    settings = {
+            "dir_in": dir_in,
+            "dir_subplots": dir_subplots,
+            "label_mapping": label_mapping,
+            "max_nZones": max_nZones,
+            "chunksize": chunksize,
+            "cache_dir": cache_dir,
+            "cache_size_mb": cache_size_mb,
+            "timezone": timezone,
+            "timezones": timezones,
+            "time_format": time_format,
+            "schema": schema,
+            "checkpoint_dir": checkpoint_dir,
+            "trace_filepath": trace_filepath,
+            "include_plotlyjs": "directory" if plot_output == "shared" else True,
+            # The report page plots from the household data instead of subplots
+            "plot": plot_output not in ("none", "report")
+    }
+
+    # Every (RLID, month) task is independent, results are merged in this order
+    tasks = [(rlid, month) for rlid in rlids for month in months]
+
+    if (args.shard or args.reduce) and not shard_dir:
+        parser.error('--shard and --reduce need a "Shard Dir" in the config')
+
+    # Sharded worker: save the results of the claimed tasks for --reduce
+    if args.shard:
+        shard, n_shards = [int(x) for x in args.shard.split("/")]
+        queue = lib.ShardQueue(shard_dir, tasks, shard, n_shards)
+        for rlid, month in queue:
+            print("Calculating Comfortband: {} {}".format(rlid, month))
+            queue.save_result((rlid, month), run_task(rlid, month, settings))
+
+        sys.exit()
+
+    if trace_filepath and os.path.exists(trace_filepath):
+        os.remove(trace_filepath)
+
+    # Task workers already overlap stats and plotting, so the background
+    # writer is only used for serial runs
+    if args.reduce:
+        pool = None
+        writer = None
+        results = lib.ShardQueue(shard_dir, tasks).load_results()
+    elif workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        writer = None
+        futures = [pool.submit(run_task, rlid, month, settings) for rlid, month in tasks]
+        results = (future.result() for future in futures)
+    else:
+        pool = None
+        writer = lib.AsyncWriter(plot_workers, max_pending=2*plot_workers) if plot_workers and settings["plot"] else None
+        results = (run_task(rlid, month, settings, writer) for rlid, month in tasks)
+
+    # Create Results DataFrames List
+    all_comfbands = []
+
+    # Streamed result files, written as each task finishes
+    results_prefix = os.path.splitext(comf1090_filepath)[0]
+    sinks = [lib.get_result_sink(fmt, results_prefix) for fmt in results_formats if fmt != "xlsx"]
+
+    ################################################
+    # Plot frequency of occurency of room temperatres and setpoint ranges
+
+    # Create Output HTML File
+    if settings["plot"]:
+        HTML_comfband = lib.init_HTML(comfband_filepath)
+    else:
+        HTML_comfband = None
+
+    # Households of the report page, (rlid, data filepath, months)
+    report = []
+
+    for rlid in rlids:
+        print("Plotting Comfortband: {}".format(rlid))
+
+        df_1090s = []
+        report_months = []
+        for month in months:
+            (df_1090, savepath, comfband_counts), records = next(results)
+            df_1090s.append(df_1090)
+            report_months.append((month, comfband_counts))
+
+            if trace_filepath:
+                lib.start_trace(rlid=rlid, month=month)
+
+            # Update HTML File
+            if HTML_comfband is not None:
+                with lib.trace_stage("write_html", 1):
+                    lib.add_HTML_plot(HTML_comfband, savepath, lazy=(plot_output == "shared"))
+
+            if sinks:
+                with lib.trace_stage("write_results", len(comfband_counts)):
+                    tables = lib.get_result_tables(df_1090, comfband_counts, rlid, month, max_nZones)
+                    for sink in sinks:
+                        for table, df in tables.items():
+                            sink.write(table, df)
+
+            if trace_filepath:
+                lib.write_trace(records + lib.stop_trace(), trace_filepath)
+
+        all_comfbands.append(pd.concat(df_1090s).reset_index(drop=True))
+
+        if plot_output == "report":
+            report_filepath = "{}{}_comfbands.js".format(dir_subplots, rlid)
+            lib.save_report_data(report_filepath, rlid, report_months)
+            report.append((rlid, report_filepath, months))
+
+    if HTML_comfband is not None:
+        HTML_comfband.write("</body>\n</html>")
+
+        HTML_comfband.close()
+
+    if plot_output == "report":
+        lib.write_report_page(comfband_filepath, report)
+
+    if pool is not None:
+        pool.shutdown()
+
+    # Export Comfort Band Stats to Excel
+    if trace_filepath:
+        lib.start_trace(rlid=None, month=None)
+
+    if "xlsx" in results_formats:
+        with lib.trace_stage("save_xls", len(all_comfbands)):
+            lib.save_xls(all_comfbands, comf1090_filepath)
+
+    for sink in sinks:
+        sink.close()
+
+    if trace_filepath:
+        lib.write_trace(lib.stop_trace(), trace_filepath)
+
+    # Wait for the background plots, raising any plotting error
+    if writer is not None:
+        for records in writer.close():
+            if trace_filepath:
+                lib.write_trace(records, trace_filepath)
+
+    if trace_filepath:
+        # Print the slowest households and stages
+        tasks, stages = lib.summarize_trace(lib.read_trace(trace_filepath))
+        print("Slowest tasks [s]:\n{}".format(tasks.to_string()))
+        print("Stages:\n{}".format(stages.to_string()))
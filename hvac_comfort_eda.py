@@ -10,10 +10,9 @@ import re
 import pandas as pd
 from pandas import ExcelWriter
 import numpy as np
-import plotly
 import plotly.offline as pyo
 import plotly.graph_objs as go
-import plotly.figure_factory as ff
+import hvac_comfort_lib as lib
 
 label_mapping_file = "../data_label_mapping.xlsx"
 label_mapping_sheet = "HVAC" 
@@ -27,8 +26,7 @@ def save_xls(list_dfs, xls_path):
     with ExcelWriter(xls_path) as writer:
         for n, df in enumerate(list_dfs):
             sheetname = "sheet{}".format(n)
-            df.to_excel(writer, sheetname)
-        writer.save()
+            df.to_excel(writer, sheet_name=sheetname)
 
 def drop_keys_from_dict(D, string):
     D_new = {k: D[k] for k in D if not k.startswith(string)}
@@ -318,49 +316,11 @@ def get_off_counts(df, zone):
      
 
 def find_sp_changes(df):
-
-    for mode in ["heat", "cool"]:
-        for zone in range(0,max_nZones):
-            sp_col = "{}_sp_{}".format(mode, zone)
-            rt_col = "rm_temp_{}".format(zone)
-
-            if sp_col not in df:
-                continue
-            df[sp_col+"_change"] = df[sp_col] - df[sp_col].shift()
-            df[sp_col+"_change"] = df[sp_col+"_change"].fillna(0)
-
-            # Replace difference with true/false
-            df.loc[df[sp_col+"_change"]!=0, sp_col+"_change"] = True
-            df.loc[df[sp_col+"_change"]==0, sp_col+"_change"] = False
-
-            df["is_manual"] = df["ts_mode_{}".format(zone)] == "Manual"
-
-            df[sp_col+"_man_change"] = df[sp_col+"_change"] & df["hold_on"] # & df["is_manual"]
-
-            df[rt_col+"_counter"] = df.groupby((df[rt_col] != df[rt_col].shift(1)).cumsum()).cumcount()
-            df[rt_col+"_times"] = False
-            df.loc[df[rt_col+"_counter"]==0, rt_col+"_times"] = True
-
-    df["change_flag"] = df[[col for col in df.columns if ("_change" in col) & ("_man" not in col)]].sum(axis=1) != 0
-
-    return df
+    # Vectorized in the lib, with the same columns
+    return lib.find_sp_changes(df, max_nZones)
 
 def count_sp_changes(df, zone_num):
-    rt_col = "rm_temp_{}".format(zone_num)
-    hsp_col = "heat_sp_{}_man_change".format(zone_num)
-    csp_col = "cool_sp_{}_man_change".format(zone_num)
-    rt_count_col = rt_col + "_times"
-
-    df_counts = df[[rt_col, hsp_col, csp_col, rt_count_col]].groupby(rt_col).sum()
-
-    df_size = df[rt_col].value_counts()
-
-    df_counts = df_counts.join(df_size)
-
-    df_counts[hsp_col+"_norm"] = df_counts[hsp_col]/df_counts[rt_col]
-    df_counts[csp_col+"_norm"] = df_counts[csp_col]/df_counts[rt_col]
-
-    return df_counts
+    return lib.count_sp_changes(df, zone_num)
 
 def plot_sp_change_counts(df, savepath):
     for col in df:
@@ -1,21 +1,102 @@
 import os
 import re
+import json
+import time
+import hashlib
+import functools
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from pandas import ExcelWriter
 import numpy as np
-import plotly
-import plotly.offline as pyo
-import plotly.graph_objs as go
-import plotly.figure_factory as ff
+
+# Compact dtypes for model labels starting with each prefix, used by
+# get_label_schema when the label mapping does not declare a dtype
+DEFAULT_DTYPES = {
+        "rm_temp": "float32",
+        "heat_sp": "float32",
+        "cool_sp": "float32",
+        "op_mode": "category",
+        "ts_mode": "category",
+        "hold_on": "bool"
+}
+
+# Stage timings of the current task, see start_trace
+_TRACE = {"task": None, "records": None}
 
 def read_config(filepath):
-    df = pd.read_excel(filepath)
+    df = read_excel_cached(filepath)
     return df
 
-def get_val(df, var):
-    value = df.loc[df["Parameter"]==var, "Value"].values[0]
+def read_excel_cached(filepath, sheetname=0, cache_dir=None):
+    """
+    Same as pd.read_excel, but keeps the parsed sheet in a pickle that is
+    reused until the workbook's size or modification time changes. Loading
+    the pickle takes milliseconds, parsing the workbook takes most of a
+    second.
+
+    The cache is kept in a .xlsx_cache directory next to the workbook unless
+    cache_dir is given, with one entry per sheet that replaces the old one
+    when the workbook changes. If it can't be written the sheet is still
+    returned.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), ".xlsx_cache")
+
+    stat = os.stat(filepath)
+    prefix = "{}_{}_".format(os.path.basename(filepath), _hash_key(os.path.abspath(filepath), sheetname))
+    # Pickles can't always be read by another pandas version
+    data_key = _hash_key(stat.st_size, stat.st_mtime_ns, pd.__version__)
+    cache_path = os.path.join(cache_dir, "{}{}.pkl".format(prefix, data_key))
+
+    # Another process may replace the entry, then the sheet is read again
+    try:
+        return pd.read_pickle(cache_path)
+    except FileNotFoundError:
+        pass
+
+    df = pd.read_excel(filepath, sheetname)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Remove stale entries for the same workbook and sheet
+        for filename in os.listdir(cache_dir):
+            if filename.startswith(prefix) and filename.endswith(".pkl"):
+                try:
+                    os.remove(os.path.join(cache_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+        _atomic_write(cache_path, df.to_pickle)
+    except OSError:
+        pass
+
+    return df
+
+def get_val(df, var, default=None):
+    values = df.loc[df["Parameter"]==var, "Value"].values
+
+    # Optional parameters fall back to default when missing or left blank
+    if (default is not None) and ((len(values) == 0) or pd.isnull(values[0])):
+        return default
+
+    value = values[0]
     return value
 
+def get_value_mapping(df, var, default=None):
+    """
+    Reads a "key: value, key: value" parameter into a dict, e.g.
+    "RL25: US/Eastern, RL29: US/Mountain"
+    """
+    value = get_val(df, var, "")
+    if value == "":
+        return {} if default is None else default
+
+    pairs = [x.split(":", 1) for x in value.split(",")]
+    return {key.strip(): val.strip() for key, val in pairs}
+
 def get_values(df, var):
     value = df.loc[df["Parameter"]==var, "Value"].values[0]
 
@@ -27,55 +108,852 @@ def save_xls(list_dfs, xls_path):
     with ExcelWriter(xls_path) as writer:
         for n, df in enumerate(list_dfs):
             sheetname = "sheet{}".format(n)
-            df.to_excel(writer, sheetname)
-        writer.save()
+            df.to_excel(writer, sheet_name=sheetname)
+
+def get_result_tables(df_1090, comfband_counts, rlid, month, max_nZones):
+    """
+    Puts the results of one (RLID, month) task into tables with the same
+    columns for every household, so they can be appended to a result sink.
+    Returns:
+        tables: dict of
+            "comf1090": df_1090 with a column for each of the max_nZones zones
+                and the RLID and month
+            "comfband_counts": comfband_counts in long format, with columns
+                RLID, month, temp, count_type (the comfband_counts column) and
+                count
+    """
+    stat_cols = ["rt_10p_{}", "rt_90p_{}", "rt_off_10p_{}", "rt_off_90p_{}"]
+    columns = [col.format(zone) for zone in range(0, max_nZones) for col in stat_cols]
+
+    comf1090 = df_1090.reset_index(drop=True)
+    comf1090 = comf1090.reindex(columns=columns).astype(np.float64)
+    comf1090["start_date"] = df_1090["start_date"].values
+    comf1090["end_date"] = df_1090["end_date"].values
+    comf1090["RLID"] = rlid
+    comf1090["month"] = month
+
+    counts = comfband_counts.copy()
+    counts.columns = [str(col) for col in counts.columns]
+    counts = counts.rename_axis("temp").reset_index().melt(id_vars="temp", var_name="count_type", value_name="count")
+    counts = counts.dropna(subset=["count"])
+    counts.insert(0, "RLID", rlid)
+    counts.insert(1, "month", month)
+    counts["temp"] = counts["temp"].astype(np.float64)
+    counts["count"] = counts["count"].astype(np.float64)
+
+    return {"comf1090": comf1090, "comfband_counts": counts.reset_index(drop=True)}
+
+class CSVSink:
+    """
+    Appends result tables to "{prefix}_{table}.csv" files as they are written.
+    """
+    ext = "csv"
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.paths = {}
+
+    def write(self, table, df):
+        if table not in self.paths:
+            self.paths[table] = "{}_{}.{}".format(self.prefix, table, self.ext)
+            df.to_csv(self.paths[table], index=False)
+        else:
+            df.to_csv(self.paths[table], mode="a", header=False, index=False)
+
+    def close(self):
+        return list(self.paths.values())
+
+class ParquetSink:
+    """
+    Streams result tables to "{prefix}_{table}.parquet" files, one row group
+    per write. The schema of each table is set by its first write.
+    """
+    ext = "parquet"
+
+    def __init__(self, prefix):
+        import pyarrow
+        self.pa = pyarrow
+        self.prefix = prefix
+        self.writers = {}
+        self.schemas = {}
+        self.paths = {}
+
+    def write(self, table, df):
+        if table not in self.writers:
+            batch = self.pa.Table.from_pandas(df, preserve_index=False)
+            self.schemas[table] = batch.schema
+            self.paths[table] = "{}_{}.{}".format(self.prefix, table, self.ext)
+            self.writers[table] = self._open(self.paths[table], batch.schema)
+        else:
+            batch = self.pa.Table.from_pandas(df, schema=self.schemas[table], preserve_index=False)
+        self.writers[table].write_table(batch)
+
+    def _open(self, path, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(path, schema)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        return list(self.paths.values())
+
+class ArrowSink(ParquetSink):
+    """
+    Same as ParquetSink, but writes Arrow IPC files, which can be memory
+    mapped by the reader.
+    """
+    ext = "arrow"
+
+    def _open(self, path, schema):
+        return self.pa.ipc.new_file(path, schema)
+
+class XlsxSink:
+    """
+    Appends result tables to one sheet each of "{prefix}_tables.xlsx" with an
+    openpyxl write-only workbook, which holds a constant amount of memory
+    regardless of the number of rows. Tables longer than an Excel sheet are
+    continued on "{table}_2", "{table}_3", etc.
+    """
+    ext = "xlsx"
+    max_rows = 1048576
+
+    def __init__(self, prefix):
+        from openpyxl import Workbook
+        self.path = "{}_tables.{}".format(prefix, self.ext)
+        self.workbook = Workbook(write_only=True)
+        self.sheets = {}
+
+    def write(self, table, df):
+        for row in df.itertuples(index=False):
+            sheet = self._get_sheet(table, list(df.columns))
+            sheet["worksheet"].append([None if pd.isnull(val) else val for val in row])
+            sheet["rows"] += 1
+
+    def _get_sheet(self, table, columns):
+        sheet = self.sheets.get(table)
+        if sheet is None or sheet["rows"] == self.max_rows:
+            n = sheet["n"] + 1 if sheet is not None else 1
+            title = table if n == 1 else "{}_{}".format(table, n)
+            sheet = {"worksheet": self.workbook.create_sheet(title), "rows": 1, "n": n}
+            sheet["worksheet"].append(columns)
+            self.sheets[table] = sheet
+        return sheet
+
+    def close(self):
+        self.workbook.save(self.path)
+        return [self.path]
+
+RESULT_SINKS = {
+        "csv": CSVSink,
+        "parquet": ParquetSink,
+        "arrow": ArrowSink,
+        "xlsx_stream": XlsxSink
+}
+
+def get_result_sink(fmt, prefix):
+    """
+    Creates the result sink for a "Results Formats" value (see RESULT_SINKS).
+    Sinks have write(table, df) to append a dataframe to a table and close()
+    to finish the files, which returns their paths.
+    """
+    if fmt not in RESULT_SINKS:
+        raise ValueError("Unknown results format {}, expected one of {}".format(fmt, ", ".join(RESULT_SINKS)))
+    return RESULT_SINKS[fmt](prefix)
 
 def get_label_mapping(filepath, sheetname):
     # Create data label mapping dict from spreadsheet
-    label_mapping = pd.read_excel(filepath, sheetname)
+    label_mapping = read_excel_cached(filepath, sheetname)
     label_mapping = label_mapping.set_index("Southern_Labels")
     label_mapping = label_mapping.to_dict()["Model_Labels"]
     return label_mapping
 
+def get_label_schema(filepath, sheetname):
+    """
+    Creates a {model label: dtype} dict for import_hvac from the optional
+    "Model_Dtypes" column of the label mapping spreadsheet. Labels without a
+    declared dtype get the DEFAULT_DTYPES entry for their prefix, if any.
+    """
+    label_mapping = read_excel_cached(filepath, sheetname)
+    if "Model_Dtypes" not in label_mapping:
+        label_mapping["Model_Dtypes"] = np.nan
+
+    schema = {}
+    for label, dtype in zip(label_mapping["Model_Labels"], label_mapping["Model_Dtypes"]):
+        if pd.isnull(label):
+            continue
+        if pd.isnull(dtype):
+            dtype = DEFAULT_DTYPES.get(re.sub(r'_\d+$','',label))
+        if dtype is not None:
+            schema[label] = dtype
+
+    return schema
+
+def apply_schema(df, schema):
+    """
+    Converts the columns of df to the compact dtypes in schema. Columns are
+    only downcast from a matching kind of data, e.g. a numeric column to a
+    smaller float or a 0/1 column to bool, so unexpected raw values are left
+    as they are instead of being mangled.
+    """
+    for col, dtype in schema.items():
+        if col not in df:
+            continue
+
+        values = df[col]
+        if dtype == "category":
+            df[col] = values.astype("category")
+        elif dtype == "bool":
+            if pd.api.types.is_bool_dtype(values):
+                continue
+            if pd.api.types.is_numeric_dtype(values) and values.dropna().isin([0, 1]).all():
+                df[col] = values.astype("boolean" if values.hasnans else "bool")
+        elif pd.api.types.is_numeric_dtype(values):
+            df[col] = values.astype(dtype)
+
+    return df
+
+def start_trace(**task):
+    """
+    Starts recording the wall time, rows and memory change of each pipeline
+    stage (see trace_stage) in this process, labelled with the task fields,
+    e.g. start_trace(rlid="RL25", month="2018-07").
+    """
+    _TRACE["task"] = task
+    _TRACE["records"] = []
+
+def stop_trace():
+    """Stops recording and returns the list of stage records since start_trace"""
+    records = _TRACE["records"] or []
+    _TRACE["task"] = None
+    _TRACE["records"] = None
+    return records
+
+@contextlib.contextmanager
+def trace_stage(stage, rows=None):
+    """
+    Records the block as a pipeline stage when a trace is started. Yields
+    the record so the block can set the number of rows it processed.
+
+    Usage:
+        with trace_stage("read_csv") as record:
+            df = pd.read_csv(filepath)
+            record["rows"] = len(df)
+    """
+    if _TRACE["records"] is None:
+        yield {}
+        return
+
+    record = dict(_TRACE["task"])
+    record.update({"stage": stage, "rows": rows})
+    start_rss = _get_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        end_rss = _get_rss()
+        if (start_rss is None) or (end_rss is None):
+            record["mem_delta_mb"] = None
+        else:
+            record["mem_delta_mb"] = (end_rss - start_rss) / 1024**2
+        _TRACE["records"].append(record)
+
+def _get_rss():
+    # Resident memory of this process in bytes, or None if it can't be read
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def write_trace(records, filepath):
+    """Appends stage records to a JSON lines trace file"""
+    with open(filepath, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+
+def read_trace(filepath):
+    """Reads a JSON lines trace file into a dataframe"""
+    return pd.read_json(filepath, lines=True)
+
+def summarize_trace(trace, n=10):
+    """
+    Summarizes a trace dataframe from read_trace.
+    Returns:
+        tasks: the n slowest (rlid, month) tasks with their total time
+        stages: time, rows and memory change per stage, slowest first
+    """
+    task_trace = trace.dropna(subset=["rlid", "month"])
+    tasks = task_trace.groupby(["rlid", "month"])["seconds"].sum().sort_values(ascending=False).head(n)
+
+    stages = trace.groupby("stage").agg(
+            seconds=("seconds", "sum"),
+            calls=("seconds", "size"),
+            rows=("rows", "sum"),
+            max_mem_delta_mb=("mem_delta_mb", "max"))
+    stages["rows_per_s"] = stages["rows"] / stages["seconds"]
+    stages = stages.sort_values("seconds", ascending=False)
+
+    return tasks, stages
+
 def init_HTML(filepath):
     HTML = open(filepath, "w")
     HTML.write("<html>\n<head></head>\n<body>\n")
     return HTML
 
+def add_HTML_plot(HTML, savepath, lazy=False):
+    """
+    Adds a subplot to an HTML index from init_HTML. Lazy subplots are only
+    loaded by the browser when they are scrolled into view, so an index of
+    many subplots opens quickly.
+    """
+    if lazy:
+        HTML.write('<iframe src="{}" width="100%" height="400" loading="lazy" frameborder="0"></iframe>\n'.format(savepath))
+    else:
+        HTML.write('<object data="{}" width="100%" height="400"></object>\n'.format(savepath))
+
+
+def import_hvac(filepath, label_mapping, tz="US/Central", time_format=None, schema=None):
+    # Read CSV, only parsing the columns that can map to a model label
+    positions, dtypes = get_header_projection(filepath, label_mapping, schema)
+    with trace_stage("read_csv") as record:
+        df = _read_projection(filepath, positions, dtypes)
+        record["rows"] = len(df)
 
-def import_hvac(filepath, label_mapping):
-    # Read CSV
-    df = pd.read_csv(filepath)
+    with trace_stage("normalize_columns", len(df)):
+        # Remove null columns
+        df = df.dropna(axis = 1, how = 'all')
 
-    # Remove null columns
-    df = df.dropna(axis = 1, how = 'all')
+        # Remove the ".1" from the end of column names
+        df = df.rename(columns=lambda x: re.sub(r'\.1','',x))
 
-    # Remove the ".1" from the end of column names
-    df = df.rename(columns=lambda x: re.sub('\.1','',x))
+        df = df.loc[:,~df.columns.duplicated()]
 
-    df = df.loc[:,~df.columns.duplicated()]
+        # Rename columns according to label mapping
+        df = df.rename(columns=label_mapping)
 
-    # Rename columns according to label mapping
-    df = df.rename(columns=label_mapping)
+        # Drop Columns witn no column name
+        df = df.loc[:, df.columns.notnull()]
 
-    # Drop Columns witn no column name
-    df = df.loc[:, df.columns.notnull()]
+        # Remove columns not in the label_mapping dict
+        df = df.filter(items = list(label_mapping.values()))
 
-    # Remove columns not in the label_mapping dict
-    df = df.filter(items = list(label_mapping.values()))
+        # Convert to compact dtypes
+        if schema is not None:
+            df = apply_schema(df, schema)
 
     # Convert UTC times to US/Central
-    df = localize_time(df)
+    with trace_stage("localize_time", len(df)):
+        df = localize_time(df, tz2=tz, time_format=time_format)
 
     return df
 
-def localize_time(df, tz1="UTC", tz2="US/Central"):
-    # Converts from "Timestamp" column from tz1(UTC) to tz2(US/Central)
-    df["Timestamp"] = pd.to_datetime(df.Timestamp)
-    df["Timestamp"] = df["Timestamp"].dt.tz_localize("UTC") # Add UTC timezone
-    df["Timestamp"] = df["Timestamp"].dt.tz_convert("US/Central").dt.tz_localize(None) # Convert to Central, then drop tz.
+def import_hvac_cached(filepath, label_mapping, cache_dir, max_cache_mb=2048, tz="US/Central", time_format=None,
+                       schema=None):
+    """
+    Same as import_hvac, but keeps the normalized dataframe in a parquet file
+    under cache_dir so that re-runs skip parsing the CSV.
+
+    Cache files are keyed by the source file (path, size and modification
+    time), the label mapping, the time settings and the schema, so changing
+    any of them re-imports the file and replaces the old entry. The least
+    recently used entries are removed when the cache grows past max_cache_mb.
+    """
+    stat = os.stat(filepath)
+    source_key = _hash_key(os.path.abspath(filepath))
+    data_key = _hash_key(stat.st_size, stat.st_mtime_ns, sorted(label_mapping.items(), key=str), tz, time_format,
+                         schema)
+    cache_path = os.path.join(cache_dir, "{}_{}.parquet".format(source_key, data_key))
+
+    # Another worker may evict the entry at any point, then it is reimported
+    try:
+        os.utime(cache_path) # Mark as recently used
+        with trace_stage("read_cache") as record:
+            df = pd.read_parquet(cache_path)
+            record["rows"] = len(df)
+        return df
+    except FileNotFoundError:
+        pass
+
+    df = import_hvac(filepath, label_mapping, tz, time_format, schema)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Remove stale entries for the same source file. Another worker importing
+    # the same file may remove them first.
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(source_key + "_") and filename.endswith(".parquet"):
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except FileNotFoundError:
+                pass
+
+    with trace_stage("write_cache", len(df)):
+        _atomic_write(cache_path, df.to_parquet)
+
+        _evict_cache(cache_dir, max_cache_mb)
 
     return df
+
+def _atomic_write(filepath, write_func):
+    """
+    Calls write_func with a temporary path of this process and then renames
+    it to filepath, so an interrupted writer never leaves a partial file and
+    concurrent writers don't share a temporary file.
+    """
+    tmp_path = "{}.{}.tmp".format(filepath, os.getpid())
+    try:
+        write_func(tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _hash_key(*values):
+    return hashlib.sha1(repr(values).encode()).hexdigest()[:16]
+
+def _evict_cache(cache_dir, max_cache_mb):
+    # Remove least recently used parquet files until the cache fits in max_cache_mb.
+    # Files may be removed by other worker processes while this runs.
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith(".parquet"):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, filename)))
+
+    entries = sorted(entries)
+    total = sum([size for mtime, size, path in entries])
+
+    while entries and (total > max_cache_mb * 1024**2):
+        mtime, size, oldest = entries.pop(0)
+        total -= size
+        try:
+            os.remove(oldest)
+        except FileNotFoundError:
+            pass
+
+def get_fingerprint(filepaths, *params):
+    """
+    Fingerprint of a task's input files (path, size and modification time)
+    and any parameters that change its results. Dict parameters such as the
+    label mapping are compared by their sorted items.
+    """
+    files = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        files.append((os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns))
+
+    params = [sorted(p.items(), key=str) if isinstance(p, dict) else p for p in params]
+
+    return _hash_key(files, params)
+
+def load_checkpoint(checkpoint_dir, task, fingerprint):
+    """
+    Returns the result saved by save_checkpoint for task (e.g. an (RLID,
+    month) tuple), or None if there is no checkpoint, its fingerprint does
+    not match, or the result's output file is missing.
+    """
+    filepath = _checkpoint_path(checkpoint_dir, task)
+    if not os.path.exists(filepath):
+        return None
+
+    checkpoint = pd.read_pickle(filepath)
+    if checkpoint["fingerprint"] != fingerprint:
+        return None
+    if (checkpoint["output"] is not None) and not os.path.exists(checkpoint["output"]):
+        return None
+
+    return checkpoint["result"]
+
+def save_checkpoint(checkpoint_dir, task, fingerprint, result, output=None):
+    """
+    Saves the result of a finished task so later runs can skip it.
+    output is an optional file written by the task, which must still exist
+    for the checkpoint to be used.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    filepath = _checkpoint_path(checkpoint_dir, task)
+
+    checkpoint = {"task": task, "fingerprint": fingerprint, "result": result, "output": output}
+
+    _atomic_write(filepath, lambda path: pd.to_pickle(checkpoint, path))
+
+def _checkpoint_path(checkpoint_dir, task):
+    return os.path.join(checkpoint_dir, "{}.pkl".format(_task_name(task)))
+
+def _task_name(task):
+    # File name for a task tuple, made unique by a hash of the task
+    name = "_".join([str(x) for x in task])
+    name = re.sub(r'[^\w\-]', '_', name)
+    return "{}_{}".format(name, _hash_key(task)[:8])
+
+def read_rlids(filepath):
+    """
+    Reads a list of RLIDs, one per line, for fleets too large for the
+    config's "RLIDs" row. Blank lines are skipped.
+    """
+    with open(filepath) as f:
+        rlids = [line.strip() for line in f]
+    return [rlid for rlid in rlids if rlid]
+
+class ShardQueue:
+    """
+    Splits a list of tasks between n_shards workers, on one or many hosts,
+    that share shard_dir. Task n belongs to shard n % n_shards, so the split
+    only depends on the task list. Iterating yields the tasks this worker
+    claimed: its own tasks first, then unfinished tasks stolen from the end
+    of the other shards' lists once it runs out.
+
+    Tasks are claimed by creating a claim file, which only one worker can
+    do, and their results are saved with save_result for load_results to
+    merge. A restarted worker re-runs the tasks it claimed but didn't
+    finish; tasks claimed by a worker that never comes back can be freed by
+    deleting shard_dir/claims.
+    """
+    def __init__(self, shard_dir, tasks, shard=0, n_shards=1):
+        if not 0 <= shard < n_shards:
+            raise ValueError("Shard {} is not in 0 to {}".format(shard, n_shards - 1))
+
+        self.tasks = tasks
+        self.shard = shard
+        self.n_shards = n_shards
+        self.claims_dir = os.path.join(shard_dir, "claims")
+        self.results_dir = os.path.join(shard_dir, "results")
+
+    def __iter__(self):
+        # Own tasks in order, then the other shards' tasks from the end
+        order = [self.tasks[n::self.n_shards] for n in range(self.n_shards)]
+        order = order[self.shard:] + order[:self.shard]
+        order = order[0] + [task for shard_tasks in order[1:] for task in reversed(shard_tasks)]
+
+        for task in order:
+            if self.claim(task):
+                yield task
+
+    def claim(self, task):
+        """
+        Claims an unfinished task for this worker. Returns False if the task
+        is finished or another worker has it.
+        """
+        if os.path.exists(self._result_path(task)):
+            return False
+
+        os.makedirs(self.claims_dir, exist_ok=True)
+        claim_path = os.path.join(self.claims_dir, _task_name(task))
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Unfinished claims of this shard are from an earlier, stopped run
+            with open(claim_path) as f:
+                return f.read() == str(self.shard)
+
+        with os.fdopen(fd, "w") as f:
+            f.write(str(self.shard))
+        return True
+
+    def save_result(self, task, result):
+        os.makedirs(self.results_dir, exist_ok=True)
+        filepath = self._result_path(task)
+
+        _atomic_write(filepath, lambda path: pd.to_pickle(result, path))
+
+    def missing(self):
+        """Tasks without a saved result"""
+        return [task for task in self.tasks if not os.path.exists(self._result_path(task))]
+
+    def load_results(self):
+        """
+        Returns a generator of the saved results in task order. Raises a
+        ValueError if any task is unfinished.
+        """
+        missing = self.missing()
+        if missing:
+            raise ValueError("{} of {} tasks are unfinished, e.g. {}".format(len(missing), len(self.tasks), missing[0]))
+
+        return (pd.read_pickle(self._result_path(task)) for task in self.tasks)
+
+    def _result_path(self, task):
+        return os.path.join(self.results_dir, "{}.pkl".format(_task_name(task)))
+
+def import_hvac_chunks(filepath, label_mapping, chunksize=100000, tz="US/Central", time_format=None, schema=None):
+    """
+    Streaming version of import_hvac. Yields normalized dataframes of at most
+    chunksize rows so that peak memory does not depend on the file size.
+
+    The file is read twice: once to find the columns that have data anywhere
+    in the file (import_hvac drops all-null columns before de-duplicating),
+    then again reading only the columns that map to model labels. Both reads
+    skip the columns left out by get_header_projection.
+    """
+    positions, dtypes = get_header_projection(filepath, label_mapping, schema)
+    with trace_stage("scan_columns") as record:
+        try:
+            nonnull, record["rows"] = _scan_nonnull(filepath, positions, dtypes, chunksize)
+        except ValueError:
+            if not dtypes:
+                raise
+            # Not all values are numbers, leave the columns to apply_schema
+            dtypes = {}
+            nonnull, record["rows"] = _scan_nonnull(filepath, positions, dtypes, chunksize)
+
+        usecols, labels = resolve_columns(nonnull.index[nonnull], label_mapping)
+
+    reader = pd.read_csv(filepath, usecols=positions, dtype=dtypes, chunksize=chunksize)
+    while True:
+        with trace_stage("read_csv") as record:
+            chunk = next(reader, None)
+            record["rows"] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+
+        with trace_stage("normalize_columns", len(chunk)):
+            chunk = chunk[usecols]
+            chunk.columns = labels
+
+            # Convert to compact dtypes
+            if schema is not None:
+                chunk = apply_schema(chunk, schema)
+
+        # Convert UTC times to US/Central
+        with trace_stage("localize_time", len(chunk)):
+            chunk = localize_time(chunk, tz2=tz, time_format=time_format)
+
+        yield chunk
+
+def _scan_nonnull(filepath, positions, dtypes, chunksize):
+    # Finds the columns with data anywhere in the file and counts the rows
+    nonnull = None
+    rows = 0
+    for chunk in pd.read_csv(filepath, usecols=positions, dtype=dtypes, chunksize=chunksize):
+        chunk_nonnull = chunk.notna().any()
+        nonnull = chunk_nonnull if nonnull is None else nonnull | chunk_nonnull
+        rows += len(chunk)
+
+    return nonnull, rows
+
+def resolve_columns(columns, label_mapping):
+    """
+    Applies the column cleanup of import_hvac to a list of raw column names.
+    Returns:
+        usecols: raw column names to read, in output order
+        labels: model label for each of usecols
+    """
+    # Remove the ".1" from the end of column names, keeping the first duplicate
+    raw_cols = {}
+    for col in columns:
+        raw_cols.setdefault(re.sub(r'\.1','',col), col)
+
+    # Rename columns according to label mapping, dropping unnamed columns
+    label_cols = {}
+    for name, col in raw_cols.items():
+        label = label_mapping.get(name, name)
+        if pd.notnull(label):
+            label_cols.setdefault(label, col)
+
+    # Keep columns in the label_mapping order
+    labels = [label for label in label_mapping.values() if label in label_cols]
+    usecols = [label_cols[label] for label in labels]
+
+    return usecols, labels
+
+def get_header_projection(filepath, label_mapping, schema=None):
+    """
+    Reads the header of a raw export and finds the columns that can map to a
+    model label once the ".1" suffixes are removed and the label mapping is
+    applied, so the rest of the file can be parsed without the unused
+    columns. Every duplicate of a label is kept, since which one import_hvac
+    uses depends on which are all null. Projections are cached for each
+    distinct header, so later files with the same layout skip this.
+    Returns:
+        positions: column numbers to read, in file order
+        dtypes: {column number: dtype} for the columns with a float dtype in
+            schema, which can be parsed directly as that dtype
+    """
+    header = tuple(pd.read_csv(filepath, nrows=0).columns)
+    schema_items = tuple(schema.items()) if schema is not None else None
+
+    return _project_header(header, tuple(label_mapping.items()), schema_items)
+
+@functools.lru_cache(maxsize=64)
+def _project_header(header, mapping_items, schema_items):
+    label_mapping = dict(mapping_items)
+    schema = dict(schema_items or ())
+    labels = set(label for label in label_mapping.values() if pd.notnull(label))
+
+    positions = []
+    dtypes = {}
+    for n, col in enumerate(header):
+        name = re.sub(r'\.1','',col)
+        label = label_mapping.get(name, name)
+        if label not in labels:
+            continue
+
+        positions.append(n)
+        if _is_float_dtype(schema.get(label)):
+            dtypes[n] = schema[label]
+
+    return positions, dtypes
+
+def _is_float_dtype(dtype):
+    try:
+        return (dtype is not None) and (np.dtype(dtype).kind == "f")
+    except TypeError:
+        return False
+
+def _read_projection(filepath, positions, dtypes):
+    # Parse the projected columns, falling back to inferred dtypes (for
+    # apply_schema to handle) if a column has values that aren't numbers
+    try:
+        return pd.read_csv(filepath, usecols=positions, dtype=dtypes)
+    except ValueError:
+        if not dtypes:
+            raise
+        return pd.read_csv(filepath, usecols=positions)
+
+def get_months(period):
+    """
+    Expands a period from the config into the list of months it covers.
+    A period is either a single month ("2018-09") or an inclusive range of
+    months ("2018-09 to 2018-11").
+    """
+    if " to " not in period:
+        return [period]
+
+    start, end = [x.strip() for x in period.split(" to ")]
+    return [str(month) for month in pd.period_range(start, end, freq="M")]
+
+class HVACDataset:
+    """
+    The monthly thermostat files of one household read as a single dataset,
+    in time order, without merging the CSV files on disk.
+
+    Args:
+        dir_in: directory with the "{rlid}_hvac_{month}.csv" files
+        rlid: household ID
+        months: list of months, e.g. from get_months
+        label_mapping: label mapping dict from get_label_mapping
+        start, end: optional timestamps (local time) to trim the data to
+        tz, time_format: timezone of the household and timestamp format, as
+            in localize_time
+        schema: optional dtype schema from get_label_schema
+    """
+    def __init__(self, dir_in, rlid, months, label_mapping, start=None, end=None,
+                 tz="US/Central", time_format=None, schema=None):
+        self.dir_in = dir_in
+        self.rlid = rlid
+        self.months = sorted(months)
+        self.label_mapping = label_mapping
+        self.start = start
+        self.end = end
+        self.tz = tz
+        self.time_format = time_format
+        self.schema = schema
+
+    @classmethod
+    def from_dates(cls, dir_in, rlid, start, end, label_mapping, tz="US/Central", time_format=None,
+                   schema=None):
+        """Dataset covering the months between the start and end timestamps"""
+        months = get_months("{:%Y-%m} to {:%Y-%m}".format(pd.Timestamp(start), pd.Timestamp(end)))
+        return cls(dir_in, rlid, months, label_mapping, start, end, tz, time_format, schema)
+
+    def filepaths(self):
+        return ["{}{}_hvac_{}.csv".format(self.dir_in, self.rlid, month) for month in self.months]
+
+    def iter_chunks(self, chunksize=100000):
+        """Yields normalized chunks of every file in time order, as import_hvac_chunks"""
+        for filepath in self.filepaths():
+            for chunk in import_hvac_chunks(filepath, self.label_mapping, chunksize, self.tz, self.time_format,
+                                            self.schema):
+                chunk = self._trim(chunk)
+                if len(chunk) > 0:
+                    yield chunk
+
+    def read(self, cache_dir="", max_cache_mb=2048):
+        """
+        Reads the whole dataset into one dataframe, as import_hvac. Files are
+        read through import_hvac_cached when cache_dir is given.
+        """
+        dfs = []
+        for filepath in self.filepaths():
+            if cache_dir:
+                df = import_hvac_cached(filepath, self.label_mapping, cache_dir, max_cache_mb,
+                                        self.tz, self.time_format, self.schema)
+            else:
+                df = import_hvac(filepath, self.label_mapping, self.tz, self.time_format, self.schema)
+            dfs.append(self._trim(df))
+
+        if len(dfs) == 1:
+            return dfs[0]
+
+        return pd.concat(dfs, ignore_index=True)
+
+    def _trim(self, df):
+        if self.start is not None:
+            df = df[df["Timestamp"] >= pd.Timestamp(self.start)]
+        if self.end is not None:
+            df = df[df["Timestamp"] <= pd.Timestamp(self.end)]
+        return df
+
+def localize_time(df, tz1="UTC", tz2="US/Central", time_format=None):
+    """
+    Converts the "Timestamp" column from tz1 (UTC) to tz2 (US/Central) and
+    drops the timezone.
+
+    time_format=None infers the format of each file. For a known format, the
+    timestamps are parsed straight to epochs, "ISO" for ISO 8601 timestamps
+    ("2018-07-01 00:00:00") or a strftime format otherwise, and shifted by
+    tz2's UTC offsets in one step.
+    """
+    if (time_format is None) or (tz1 != "UTC"):
+        df["Timestamp"] = pd.to_datetime(df.Timestamp, format=time_format)
+        df["Timestamp"] = df["Timestamp"].dt.tz_localize(tz1) # Add tz1 timezone
+        df["Timestamp"] = df["Timestamp"].dt.tz_convert(tz2).dt.tz_localize(None) # Convert to tz2, then drop tz.
+        return df
+
+    if time_format == "ISO":
+        utc = df["Timestamp"].fillna("NaT").to_numpy().astype("datetime64[ns]")
+    else:
+        utc = pd.to_datetime(df.Timestamp, format=time_format).to_numpy(dtype="datetime64[ns]")
+
+    epochs = utc.view(np.int64)
+    df["Timestamp"] = (epochs + _utc_offsets(epochs, tz2)).view("datetime64[ns]")
+
+    return df
+
+def _utc_offsets(epochs, tz, step=15*60*10**9):
+    """
+    UTC offset of tz in ns at each epoch (ns since 1970-01-01 UTC), looked up
+    in a table of offsets every 15 minutes between the first and last epoch.
+    """
+    offsets = np.zeros(len(epochs), dtype=np.int64)
+    valid = epochs != np.iinfo(np.int64).min # NaT
+    if not valid.any():
+        return offsets
+
+    steps = epochs[valid] // step
+    first = steps.min()
+    offsets[valid] = _get_offset_table(tz, first, steps.max(), step)[steps - first]
+
+    return offsets
+
+@functools.lru_cache(maxsize=64)
+def _get_offset_table(tz, first, last, step):
+    utc = pd.DatetimeIndex((np.arange(first, last + 1) * step).astype("datetime64[ns]"))
+    local = utc.tz_localize("UTC").tz_convert(tz).tz_localize(None)
+
+    return (local - utc).to_numpy().astype("timedelta64[ns]").view(np.int64)
+
 def get_comfortband_counts(df, zone_num):
     """
     Calculates the number of timesteps that each temperature is within the comfort
@@ -95,18 +973,117 @@ def get_comfortband_counts(df, zone_num):
     coolLabel = "cool_sp_{}".format(zone_num)
 
     if (heatLabel in df) & (coolLabel in df):
-        df_comfort = pd.DataFrame(columns = np.arange(df[heatLabel].min(), df[coolLabel].max()+1))
+        temps = np.arange(df[heatLabel].min(), df[coolLabel].max()+1)
     else:
         return None
 
-    for sp in df_comfort:
-        df_comfort[sp] = ((df[heatLabel] <= sp) & (df[coolLabel] >= sp))
+    dtype = _sp_dtype(df[heatLabel].dtype, df[coolLabel].dtype)
+    counts = _comfortband_kernel(df[[heatLabel]].to_numpy(dtype=float).T,
+                                 df[[coolLabel]].to_numpy(dtype=float).T,
+                                 [temps.astype(dtype)])
 
-    # Aggregate over time
-    df_comfort = df_comfort.sum()
+    df_comfort = pd.Series(counts[0], index=temps)
 
     return df_comfort
 
+def get_all_comfortband_counts(df, max_nZones=None):
+    """
+    Calculates the comfort band counts for every zone in a single pass.
+    Args:
+        df: dataframe containing "heat_sp_{}" and "cool_sp_{}" columns
+        max_nZones: maximum number of zones to look for in df, None for all
+    Returns:
+        df_comfort: dataframe with one column per zone present in df, with the
+            same values as concatenating get_comfortband_counts for each zone
+    """
+    return ZoneArrays.from_frame(df, ["heat_sp", "cool_sp"]).get_comfortband_counts(max_nZones)
+
+def _comfortband_kernel(heat, cool, temps, weights=None):
+    """
+    Counts, for each zone, the timesteps where heat_sp <= temp <= cool_sp for
+    every temp in that zone's temperature grid.
+
+    Each [heat_sp, cool_sp] interval is mapped to a range of grid indices and
+    added to a difference array, so a cumulative sum gives the counts. All
+    zones share one flat difference array, offset by zone.
+    Args:
+        heat, cool: (zones x timesteps) float arrays of setpoints
+        temps: list with the sorted temperature grid per zone, cast to the
+            dtype of its setpoints (see _sp_dtype)
+        weights: optional (zones x timesteps) number of timesteps each
+            setpoint pair stands for
+    Returns:
+        list with an int64 count array per zone, aligned to temps
+    """
+    nZones = len(temps)
+    sizes = np.array([len(t) for t in temps], dtype=np.int64)
+
+    # Setpoints hold for many timesteps, so each run of unchanged rows is
+    # counted once, weighted by its length
+    if (weights is None) and (heat.shape[1] > 1):
+        changed = np.ones(heat.shape[1], dtype=bool)
+        changed[1:] = ((heat[:, 1:] != heat[:, :-1]) | (cool[:, 1:] != cool[:, :-1])).any(axis=0)
+        runs = np.flatnonzero(changed)
+        if len(runs) < heat.shape[1] // 2:
+            weights = np.diff(np.append(runs, heat.shape[1]))
+            heat = heat[:, runs]
+            cool = cool[:, runs]
+
+    offsets = np.concatenate([[0], np.cumsum(sizes + 1)])
+    starts = np.array([t[0] if len(t) else 0 for t in temps], dtype=float)[:, None]
+
+    # The grids of all zones in one flat array, each between -inf and inf
+    # sentinels starting at bases, so a grid index i of a zone is at
+    # bases + i + 1
+    grid = np.concatenate([np.concatenate([[-np.inf], np.asarray(t, dtype=float), [np.inf]]) for t in temps])
+    bases = (offsets[:-1] + np.arange(nZones))[:, None]
+
+    # Grid index range [lo, hi] covered by each setpoint pair. The grid has
+    # a step of 1, so the index from the grid start is off by at most one
+    # from rounding error. It is then corrected by comparing to the grid
+    # values themselves, the same comparison as heat_sp <= temp <= cool_sp.
+    # fmax also maps NaN setpoints to a valid index, they are dropped below
+    lo = np.ceil(heat - starts)
+    np.fmax(lo, 0, out=lo)
+    np.minimum(lo, sizes[:, None], out=lo)
+    lo = lo.astype(np.int64) + bases
+    lo -= grid[lo] >= heat
+    lo += grid[lo + 1] < heat
+
+    hi = np.floor(cool - starts)
+    np.fmax(hi, -1, out=hi)
+    np.minimum(hi, sizes[:, None] - 1, out=hi)
+    hi = hi.astype(np.int64) + bases
+    hi -= grid[hi + 1] > cool
+    hi += grid[hi + 2] <= cool
+
+    valid = ~(np.isnan(heat) | np.isnan(cool)) & (lo <= hi)
+
+    # From the grid with sentinels to the difference array offsets
+    shift = offsets[:-1, None] - bases
+    lo = (lo + shift)[valid]
+    hi = (hi + shift)[valid]
+
+    if weights is not None:
+        weights = np.broadcast_to(weights, heat.shape)[valid]
+
+    diff = np.bincount(lo, weights, minlength=offsets[-1])
+    diff -= np.bincount(hi + 1, weights, minlength=offsets[-1])
+    diff = diff[:offsets[-1]].astype(np.int64)
+
+    return [np.cumsum(diff[offsets[n]:offsets[n]+sizes[n]]) for n in range(len(temps))]
+
+def _sp_dtype(*dtypes):
+    """
+    Returns the dtype that setpoint columns of the given dtypes are compared
+    to a temperature in, float32 for compact setpoints, else float64.
+    """
+    dtypes = [getattr(dtype, "numpy_dtype", dtype) for dtype in dtypes]
+    if all(dtype == np.float32 for dtype in dtypes):
+        return np.dtype(np.float32)
+
+    return np.dtype(float)
+
 def get_off_counts(df, zone):
 
     df = df[df.op_mode == "Off"]
@@ -152,53 +1129,961 @@ def calculate_temp_1090(df):
     rt_off_10p_{}
     rt_off_90p_{}
     """
-    output = pd.DataFrame(index = [0])
-
-    df_off = df[df.op_mode == "Off"]
-
-    #for zone in range(0,max_nZones):
-    for rt_col in [col for col in df.columns if "rm_temp" in col]:
-        zone = rt_col.split("_")[-1]
-        output["rt_10p_{}".format(zone)] = df[rt_col].quantile(0.1)
-        output["rt_90p_{}".format(zone)] = df[rt_col].quantile(0.9)
-        output["rt_off_10p_{}".format(zone)] = df_off[rt_col].quantile(0.1)
-        output["rt_off_90p_{}".format(zone)] = df_off[rt_col].quantile(0.9)
+    output = calculate_temp_1090_hist(get_temp_hist(df))
 
     output["start_date"] = df["Timestamp"].iloc[0]
     output["end_date"] = df["Timestamp"].iloc[-1]
     return output
 
-def plot_comfband_bars(df, savepath, fig_title):
+def get_comfband_stats(df, max_nZones=None):
     """
-    Plots bar chart for the counts of each setpoint within the comfortband
+    Calculates all of the per-file comfort band statistics together, reading
+    the setpoint and room temperature columns of every zone once (see
+    ZoneArrays).
+    Args:
+        df: dataframe from import_hvac
+        max_nZones: maximum number of zones to count setpoints for, None for
+            every zone in df
+    Returns:
+        comfband_counts: dataframe indexed by temperature with the comfort band
+            counts of each zone (as get_all_comfortband_counts), the rm_temp_{}
+            and off_rm_temp_{} counts (as get_rm_temp_counts and get_off_counts)
+            and the norm_off_rm_temp_{} ratio of off counts to room temp counts
+        df_1090: 10/90 percentiles and dates, as calculate_temp_1090
     """
+    with trace_stage("zone_arrays", len(df)):
+        arrays = ZoneArrays.from_frame(df)
 
-    for zone in df:
+    return arrays.get_comfband_stats(max_nZones)
 
+class ZoneArrays:
+    """
+    A household's data with each per-zone quantity (rm_temp, heat_sp and
+    cool_sp) stored as one (zones x timesteps) array in place of
+    the rm_temp_{} style columns, so statistics run over every zone in
+    single numpy calls.
 
-        if type(zone) == int:
-            label = "Zone {} SP".format(zone)
-            continue
-        elif "norm" in zone:
-            continue
-        elif "off_rm_temp" in zone:
-            z = zone.split("_")[-1]
-            label = "Z{} Off Counts".format(z)
-        elif "rm_temp" in zone:
-            continue # This is to ignore off counts 
-            z = zone.split("_")[-1]
-            label = "Z{} Rm Temp Counts".format(z)
-
-        trace = go.Bar(
-                x = df.index,
-                y = df[zone],
-                name = label
-        )
-
-        if "data" not in locals():
-            data = [trace]
+    Zones are numbered from 0 to the highest zone in the columns, with no
+    maximum to configure. masks holds the zones the household has for each
+    quantity; the array rows of other zones are NaN. Each zone's timesteps
+    are contiguous, so the numpy calls run long inner loops. The arrays are
+    float64, dtypes holds the dtype of each zone's column in the frame.
+
+    Usage:
+        arrays = ZoneArrays.from_frame(df)
+        comfband_counts, df_1090 = arrays.get_comfband_stats()
+    """
+    QUANTITIES = ["rm_temp", "heat_sp", "cool_sp"]
+
+    def __init__(self, quantities, masks, op_mode=None, timestamps=None, dtypes=None):
+        self.quantities = quantities
+        self.masks = masks
+        self.op_mode = op_mode
+        self.timestamps = timestamps
+        self.nZones = len(masks[self.QUANTITIES[0]])
+        if dtypes is None:
+            dtypes = {quantity: [np.dtype(float)]*self.nZones for quantity in self.QUANTITIES}
+        self.dtypes = dtypes
+
+    @classmethod
+    def find_zones(cls, columns):
+        """
+        Returns:
+            zones: {quantity: sorted zone numbers with a {quantity}_{zone} column}
+        """
+        pattern = re.compile(r'({})_(\d+)$'.format("|".join(cls.QUANTITIES)))
+        zones = {quantity: [] for quantity in cls.QUANTITIES}
+        for col in columns:
+            match = pattern.match(str(col))
+            if match:
+                zones[match.group(1)].append(int(match.group(2)))
+        return {quantity: sorted(zones[quantity]) for quantity in cls.QUANTITIES}
+
+    @classmethod
+    def from_frame(cls, df, quantities=None):
+        """
+        Creates ZoneArrays from a dataframe from import_hvac, with arrays for
+        the given quantities only, or all of QUANTITIES
+        """
+        found = cls.find_zones(df.columns)
+        nZones = max([max(zones) for zones in found.values() if zones] + [-1]) + 1
+        if quantities is None:
+            quantities = cls.QUANTITIES
+
+        arrays = {}
+        masks = {}
+        dtypes = {}
+        for quantity, zones in found.items():
+            cols = ["{}_{}".format(quantity, zone) for zone in zones]
+            if quantity in quantities:
+                values = np.full((nZones, len(df)), np.nan)
+                if zones:
+                    values[zones] = df[cols].to_numpy(dtype=float).T
+                arrays[quantity] = values
+            masks[quantity] = np.isin(np.arange(nZones), zones)
+            dtypes[quantity] = [np.dtype(float)]*nZones
+            for zone, col in zip(zones, cols):
+                dtypes[quantity][zone] = df[col].dtype
+
+        op_mode = df["op_mode"].to_numpy() if "op_mode" in df else None
+        timestamps = df["Timestamp"] if "Timestamp" in df else None
+
+        return cls(arrays, masks, op_mode, timestamps, dtypes)
+
+    def get_zones(self, *quantities):
+        """Zones the household has all of quantities for"""
+        mask = np.logical_and.reduce([self.masks[quantity] for quantity in quantities])
+        return [int(zone) for zone in np.flatnonzero(mask)]
+
+    def get_temp_hist(self):
+        """Same as get_temp_hist, with the rm_temp_{} columns in zone order"""
+        zones = self.get_zones("rm_temp")
+        return _temp_hist(self.quantities["rm_temp"][zones], self.op_mode == "Off",
+                          ["rm_temp_{}".format(zone) for zone in zones])
+
+    def get_comfortband_counts(self, max_nZones=None):
+        """Same as get_all_comfortband_counts"""
+        zones = [zone for zone in self.get_zones("heat_sp", "cool_sp")
+                 if (max_nZones is None) or (zone < max_nZones)]
+        heat = self.quantities["heat_sp"][zones]
+        cool = self.quantities["cool_sp"][zones]
+
+        # The grid starts from the setpoints in their column dtype, as in
+        # get_comfortband_counts, and is compared to them in that dtype
+        sp_dtypes = [_sp_dtype(self.dtypes["heat_sp"][zone], self.dtypes["cool_sp"][zone]) for zone in zones]
+        temps = [np.arange(dtype.type(low), dtype.type(high)+1)
+                 for low, high, dtype in zip(np.fmin.reduce(heat, axis=1), np.fmax.reduce(cool, axis=1), sp_dtypes)]
+        counts = _comfortband_kernel(heat, cool, [t.astype(dtype) for t, dtype in zip(temps, sp_dtypes)])
+
+        df_comfort = [pd.Series(c, index=t, name=zone) for zone, c, t in zip(zones, counts, temps)]
+
+        return pd.concat(df_comfort, axis=1)
+
+    def calculate_temp_1090(self):
+        """Same as calculate_temp_1090"""
+        output = calculate_temp_1090_hist(self.get_temp_hist())
+
+        output["start_date"] = self.timestamps.iloc[0]
+        output["end_date"] = self.timestamps.iloc[-1]
+        return output
+
+    def get_comfband_stats(self, max_nZones=None):
+        """Same as get_comfband_stats"""
+        rows = len(self.timestamps)
+
+        with trace_stage("temp_hist", rows):
+            hist = self.get_temp_hist()
+
+        with trace_stage("comfortband_counts", rows):
+            comfband_counts = self.get_comfortband_counts(max_nZones)
+
+        with trace_stage("join_counts", len(comfband_counts)):
+            comfband_counts = join_comfband_counts(comfband_counts, hist)
+
+        with trace_stage("percentiles", len(hist)):
+            df_1090 = calculate_temp_1090_hist(hist)
+            df_1090["start_date"] = self.timestamps.iloc[0]
+            df_1090["end_date"] = self.timestamps.iloc[-1]
+
+        return comfband_counts, df_1090
+
+def join_comfband_counts(comfband_counts, hist, max_nZones=None):
+    """
+    Joins the room temperature and off counts from a get_temp_hist histogram
+    to the comfort band counts, and adds the normalized off counts of the
+    zones (below max_nZones, if given) with comfort band counts.
+    """
+    # Only the temperatures that occur in each column, as from value_counts
+    rt_cols = [col for col in hist.columns if not col.startswith("off_")]
+    rm_temp_counts = pd.concat([hist[col][hist[col] > 0] for col in rt_cols], axis=1)
+    off_counts = pd.concat([hist["off_" + col][hist["off_" + col] > 0] for col in rt_cols], axis=1)
+
+    comfband_counts = comfband_counts.join(rm_temp_counts)
+    comfband_counts = comfband_counts.join([off_counts])
+
+    zones = sorted(col for col in comfband_counts.columns if type(col) == int)
+    for zone in zones:
+        if (max_nZones is None) or (zone < max_nZones):
+            comfband_counts["norm_off_rm_temp_{}".format(zone)] = comfband_counts["off_rm_temp_{}".format(zone)]/comfband_counts["rm_temp_{}".format(zone)]
+
+    return comfband_counts
+
+def get_temp_hist(df):
+    """
+    Counts the timesteps at each room temperature for every rm_temp_{} column,
+    for all timesteps and for timesteps where op_mode is "Off", in one pass.
+
+    Histograms of different months can be added together with merge_temp_hists
+    and passed to calculate_temp_1090_hist to get seasonal or annual stats
+    without rereading the data.
+    Returns:
+        hist: dataframe indexed by each room temperature with columns
+            rm_temp_{} and off_rm_temp_{} holding the number of timesteps
+    """
+    rt_cols = [col for col in df.columns if "rm_temp" in col]
+    return _temp_hist(df[rt_cols].to_numpy(dtype=float).T, (df.op_mode == "Off").to_numpy(), rt_cols)
+
+def _temp_hist(temps, is_off, rt_cols):
+    # get_temp_hist of a (zones x timesteps) room temperature array
+    values, bins = _zone_bins(temps, is_off)
+
+    counts = np.bincount(bins[bins >= 0], minlength=2*len(rt_cols)*len(values))
+    counts = counts.reshape(2*len(rt_cols), len(values)).T
+
+    hist = pd.DataFrame(counts, index=values, columns=rt_cols + ["off_" + col for col in rt_cols])
+
+    return hist
+
+def _zone_bins(temps, is_off):
+    # Bins of one flat histogram of a (zones x timesteps) room temperature
+    # array, with a block of len(values) bins for each zone then for each
+    # zone when off. Returns the values and a (2*zones x timesteps) array of
+    # the bin of each sample, -1 for NaN or, in the off rows, not off.
+    values, bins = _bin_temps(temps)
+
+    nZones = len(temps)
+    bins = bins + np.arange(nZones)[:, None] * len(values)
+    valid = ~np.isnan(temps)
+    bins = np.concatenate([np.where(valid, bins, -1),
+                           np.where(valid & is_off[None, :], bins + nZones*len(values), -1)])
+
+    return values, bins
+
+def _temp_1090_frame(zones, p10, p90, index=(0,)):
+    # The rt_10p_{}, rt_90p_{}, rt_off_10p_{} and rt_off_90p_{} columns of
+    # each zone from (rows x 2*zones) quantiles, with a column for each zone
+    # then for each zone when off, as _zone_bins lays out the histogram
+    p10 = np.reshape(p10, (len(index), 2*len(zones)))
+    p90 = np.reshape(p90, (len(index), 2*len(zones)))
+
+    output = pd.DataFrame(index=index)
+    for n, zone in enumerate(zones):
+        output["rt_10p_{}".format(zone)] = p10[:, n]
+        output["rt_90p_{}".format(zone)] = p90[:, n]
+        output["rt_off_10p_{}".format(zone)] = p10[:, n + len(zones)]
+        output["rt_off_90p_{}".format(zone)] = p90[:, n + len(zones)]
+
+    return output
+
+def merge_temp_hists(hists):
+    """Adds together room temperature histograms from get_temp_hist"""
+    hist = hists[0]
+    for other in hists[1:]:
+        hist = hist.add(other, fill_value=0)
+
+    return hist.fillna(0).astype(np.int64).sort_index()
+
+def calculate_temp_1090_hist(hist):
+    """
+    Same as calculate_temp_1090, without the dates, from a histogram made by
+    get_temp_hist or merge_temp_hists. Percentiles are exact.
+    """
+    rt_cols = [col for col in hist.columns if not col.startswith("off_")]
+    off_cols = ["off_" + col for col in rt_cols]
+    p10 = _quantiles_from_hist(hist[rt_cols + off_cols], 0.1)
+    p90 = _quantiles_from_hist(hist[rt_cols + off_cols], 0.9)
+
+    return _temp_1090_frame([col.split("_")[-1] for col in rt_cols], p10, p90)
+
+def get_rolling_temp_1090(df, window="14D", step="1D"):
+    """
+    Calculates the stats of calculate_temp_1090 over a sliding time window,
+    e.g. a 14 day comfort band every day, to show how it drifts. The window
+    counts are updated by adding the samples that enter and removing the
+    samples that leave at each step instead of recounting every window.
+    Args:
+        df: dataframe from import_hvac, in time order
+        window, step: pandas time deltas, e.g. "14D" and "1D"
+    Returns:
+        dataframe indexed by the end of each window, with the rt_10p_{},
+        rt_90p_{}, rt_off_10p_{} and rt_off_90p_{} columns of the samples
+        from end - window up to (not including) end. Windows start at the
+        first sample and continue until one includes the last sample.
+    """
+    rt_cols = [col for col in df.columns if "rm_temp" in col]
+    temps = df[rt_cols].to_numpy(dtype=float).T
+    is_off = (df.op_mode == "Off").to_numpy()
+
+    # Flat histogram bin of every sample and zone, as in get_temp_hist,
+    # with a row per timestep
+    values, sample_bins = _zone_bins(temps, is_off)
+    sample_bins = np.ascontiguousarray(sample_bins.T)
+    nZones = len(rt_cols)
+    nBins = 2*nZones*len(values)
+
+    timestamps = df["Timestamp"].reset_index(drop=True)
+    window = pd.Timedelta(window)
+    step = pd.Timedelta(step)
+    nSteps = max(int(np.floor((timestamps.iloc[-1] - timestamps.iloc[0] - window) / step)) + 1, 0) + 1
+    ends = timestamps.iloc[0] + window + pd.to_timedelta(np.arange(nSteps) * step)
+    starts = timestamps.searchsorted(ends - window, side="left")
+    stops = timestamps.searchsorted(ends, side="left")
+
+    def count(lo, hi):
+        rows = sample_bins[lo:hi]
+        return np.bincount(rows[rows >= 0], minlength=nBins)
+
+    counts = np.zeros(nBins, dtype=np.int64)
+    lo = hi = 0
+    p10 = []
+    p90 = []
+    for start, stop in zip(starts, stops):
+        if start >= hi:
+            # No overlap with the last window
+            counts = count(start, stop)
         else:
-            data.append(trace)
+            counts += count(hi, stop) - count(lo, start)
+        lo, hi = start, stop
+
+        window_counts = counts.reshape(2*nZones, len(values)).T
+        p10.append(_quantiles_from_counts(values, window_counts, 0.1))
+        p90.append(_quantiles_from_counts(values, window_counts, 0.9))
+
+    return _temp_1090_frame([col.split("_")[-1] for col in rt_cols], p10, p90,
+                            pd.Index(ends, name="end_date"))
+
+def to_long_format(df, **keys):
+    """
+    Converts an import_hvac dataframe to the long format of the batch
+    functions: one row per timestep and zone, with the zone number in a
+    "zone" column and the rm_temp_{}, heat_sp_{} and cool_sp_{} columns as
+    rm_temp, heat_sp and cool_sp. Other columns, e.g. Timestamp and op_mode,
+    are repeated for each zone, and keys are added as constant columns,
+    e.g. to_long_format(df, RLID="RL25", period="2018-07").
+    """
+    zones = sorted(int(col.split("_")[-1]) for col in df.columns if re.match(r'rm_temp_\d+$', col))
+    zone_cols = [col for col in df.columns if re.match(r'(rm_temp|heat_sp|cool_sp)_\d+$', col)]
+    other_cols = [col for col in df.columns if col not in zone_cols]
+
+    output = {}
+    for col, value in keys.items():
+        output[col] = np.full(len(df)*len(zones), value, dtype=object)
+    for col in other_cols:
+        output[col] = np.tile(df[col].to_numpy(), len(zones))
+    output["zone"] = np.repeat(zones, len(df))
+    for quantity in ["rm_temp", "heat_sp", "cool_sp"]:
+        cols = ["{}_{}".format(quantity, zone) for zone in zones]
+        if zones and all(col in df for col in cols):
+            output[quantity] = np.concatenate([df[col].to_numpy(dtype=float) for col in cols])
+
+    return pd.DataFrame(output)
+
+def get_long_temp_hist(df, keys=("RLID", "period", "zone")):
+    """
+    Batch version of get_temp_hist for a long format table of many
+    households, e.g. concatenated to_long_format frames. Counts the rows at
+    each room temperature of every group of keys in one pass.
+    Args:
+        df: dataframe with the keys, rm_temp and op_mode columns
+    Returns:
+        hist: dataframe with the keys, temp, count (rows at temp) and
+            off_count (rows at temp where op_mode is "Off") columns, sorted
+            by the keys and temp, with a row for each temperature that occurs
+    """
+    keys = list(keys)
+    grouped = df.groupby(keys, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    groups = grouped.size().index
+    temps = df["rm_temp"].to_numpy(dtype=float)
+    is_off = (df["op_mode"] == "Off").to_numpy()
+
+    values, bins = _bin_temps(temps)
+    valid = (codes >= 0) & ~np.isnan(temps)
+
+    # One bin per group and temperature, only keeping the bins that occur
+    flat = codes[valid].astype(np.int64) * len(values) + bins[valid]
+    flat, inverse = np.unique(flat, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(flat))
+    off_counts = np.bincount(inverse, weights=is_off[valid], minlength=len(flat)).astype(np.int64)
+
+    nValues = max(len(values), 1)
+    hist = groups.take(flat // nValues).to_frame(index=False)
+    hist["temp"] = values[flat % nValues]
+    hist["count"] = counts
+    hist["off_count"] = off_counts
+
+    return hist
+
+def calculate_temp_1090_long(hist, keys=("RLID", "period", "zone")):
+    """
+    Batch version of calculate_temp_1090_hist for a get_long_temp_hist
+    histogram. Percentiles are exact and calculated for all groups at once.
+    Returns:
+        df_1090: dataframe with the keys and the rt_10p, rt_90p, rt_off_10p
+            and rt_off_90p columns, one row per group
+    """
+    keys = list(keys)
+    group_keys = hist[keys]
+    new_group = np.ones(len(hist), dtype=bool)
+    new_group[1:] = (group_keys.iloc[1:].to_numpy() != group_keys.iloc[:-1].to_numpy()).any(axis=1)
+    starts = np.flatnonzero(new_group)
+
+    values = hist["temp"].to_numpy(dtype=float)
+    df_1090 = hist.loc[starts, keys].reset_index(drop=True)
+    for col, prefix in [("count", "rt"), ("off_count", "rt_off")]:
+        counts = hist[col].to_numpy()
+        df_1090["{}_10p".format(prefix)] = _grouped_quantiles(values, counts, starts, 0.1)
+        df_1090["{}_90p".format(prefix)] = _grouped_quantiles(values, counts, starts, 0.9)
+
+    return df_1090
+
+def _grouped_quantiles(values, counts, starts, q):
+    # Same as _quantiles_from_counts for each group of consecutive rows that
+    # begins at starts, with the values ascending within each group
+    if len(starts) == 0:
+        return np.full(0, np.nan)
+
+    cumcounts = np.cumsum(counts)
+    offset = cumcounts[starts] - counts[starts]
+    n = np.add.reduceat(counts, starts)
+
+    return _interpolate_quantiles(values, n, q,
+                                  lambda pos: np.searchsorted(cumcounts, offset + pos, side="right"))
+
+def get_long_comfband_stats(df, keys=("RLID", "period", "zone")):
+    """
+    The room temperature histograms and 10/90 stats of every group of keys
+    in a long format table, e.g. every RLID, period and zone of a fleet,
+    without a Python loop over the groups.
+    Returns:
+        hist: histogram from get_long_temp_hist
+        df_1090: stats from calculate_temp_1090_long for every group, with
+            the start_date and end_date of the group when df has a Timestamp
+            column. Groups without room temperatures have NaN stats.
+    """
+    keys = list(keys)
+    hist = get_long_temp_hist(df, keys)
+
+    grouped = df.groupby(keys, sort=True)
+    if "Timestamp" in df:
+        df_1090 = grouped["Timestamp"].agg(["first", "last"])
+        df_1090.columns = ["start_date", "end_date"]
+    else:
+        df_1090 = pd.DataFrame(index=grouped.size().index)
+
+    stats = calculate_temp_1090_long(hist, keys).set_index(keys)
+    df_1090 = stats.reindex(df_1090.index).join(df_1090).reset_index()
+
+    return hist, df_1090
+
+def _quantiles_from_hist(hist, q):
+    # Linear interpolation quantile of each column of a histogram, as numpy
+    # computes it on the sorted data
+    hist = hist.sort_index()
+    return _quantiles_from_counts(hist.index.to_numpy(dtype=float), hist.to_numpy(), q)
+
+def _quantiles_from_counts(values, counts, q):
+    # Same as _quantiles_from_hist for a (values, columns) counts array with
+    # the values in ascending order
+    cumcounts = np.cumsum(counts, axis=0)
+    n = cumcounts[-1] if len(values) else np.zeros(counts.shape[1])
+
+    return _interpolate_quantiles(values, n, q, lambda pos: (cumcounts <= pos).sum(axis=0))
+
+def _interpolate_quantiles(values, n, q, find_index):
+    # Linear interpolation quantile of each column or group with n samples,
+    # where find_index maps sorted sample positions to indices in values
+    pos = (n - 1) * q
+    below = np.floor(pos)
+    gamma = pos - below
+
+    # Index of the value at sorted positions below and below + 1
+    ia = find_index(below)
+    ib = find_index(np.minimum(below + 1, n - 1))
+
+    quantiles = np.full(len(n), np.nan)
+    has_data = n > 0
+    a = values[ia[has_data]]
+    b = values[ib[has_data]]
+    gamma = gamma[has_data]
+    quantiles[has_data] = np.where(gamma >= 0.5, b - (b - a) * (1 - gamma), a + (b - a) * gamma)
+
+    return quantiles
+
+def _bin_temps(temps, resolution=0.5):
+    """
+    Maps each temperature to the index of its value in the sorted distinct
+    temperatures. Thermostat temperatures are on a fixed grid, so this is a
+    bincount in the usual case, with a sort as the fallback for other data.
+    Returns:
+        values: sorted distinct temperatures
+        bins: int array shaped like temps, 0 where temps is NaN
+    """
+    valid = ~np.isnan(temps)
+    finite = temps[valid]
+    bins = np.zeros(temps.shape, dtype=np.int64)
+
+    if len(finite) == 0:
+        return np.array([]), bins
+
+    grid = np.round(finite / resolution)
+    lowest = grid.min()
+    if np.array_equal(grid * resolution, finite) and (grid.max() - lowest < 1e6):
+        grid = (grid - lowest).astype(np.int64)
+        used = np.bincount(grid) > 0
+        values = (np.flatnonzero(used) + lowest) * resolution
+        bins[valid] = (np.cumsum(used) - 1)[grid]
+    else:
+        values, bins[valid] = np.unique(finite, return_inverse=True)
+
+    return values, bins
+
+class ComfortStats:
+    """
+    Accumulates the comfort band statistics of a household over chunks of
+    data, e.g. from import_hvac_chunks. Only value counts are kept, so memory
+    depends on the number of distinct temperatures and not the data length.
+
+    Usage:
+        stats = ComfortStats(max_nZones)
+        for chunk in import_hvac_chunks(filepath, label_mapping):
+            stats.update(chunk)
+        df_1090 = stats.calculate_temp_1090()
+
+    max_nZones limits the zones setpoints are counted for, None counts every
+    zone in the data.
+    """
+    def __init__(self, max_nZones=None):
+        self.max_nZones = max_nZones
+        self.temp_hist = None
+        self.sp_pairs = {}
+        self.heat_min = {}
+        self.cool_max = {}
+        self.sp_dtypes = {}
+        self.start_date = None
+        self.end_date = None
+
+    def update(self, df):
+        with trace_stage("temp_hist", len(df)):
+            hist = get_temp_hist(df)
+            if self.temp_hist is None:
+                self.temp_hist = hist
+            else:
+                self.temp_hist = merge_temp_hists([self.temp_hist, hist])
+
+        found = ZoneArrays.find_zones(df.columns)
+        for zone in [zone for zone in found["heat_sp"] if zone in found["cool_sp"]]:
+            heatLabel = "heat_sp_{}".format(zone)
+            coolLabel = "cool_sp_{}".format(zone)
+            if (self.max_nZones is not None) and (zone >= self.max_nZones):
+                continue
+
+            with trace_stage("setpoint_pairs", len(df)):
+                self.sp_pairs[zone] = _add_counts(self.sp_pairs.get(zone),
+                                                  df[[heatLabel, coolLabel]].value_counts())
+                # Kept in the column dtype, which the temperature grid follows
+                low, high = df[heatLabel].min(), df[coolLabel].max()
+                self.heat_min[zone] = np.fmin(self.heat_min.get(zone, low), low)
+                self.cool_max[zone] = np.fmax(self.cool_max.get(zone, high), high)
+                self.sp_dtypes[zone] = _sp_dtype(df[heatLabel].dtype, df[coolLabel].dtype)
+
+        if len(df) > 0:
+            if self.start_date is None:
+                self.start_date = df["Timestamp"].iloc[0]
+            self.end_date = df["Timestamp"].iloc[-1]
+
+    def get_comfortband_counts(self):
+        """Same as get_all_comfortband_counts on the full data"""
+        zones = list(self.sp_pairs)
+        temps = [np.arange(self.heat_min[zone], self.cool_max[zone]+1) for zone in zones]
+
+        # Each distinct setpoint pair is one row, weighted by its count
+        pairs = [self.sp_pairs[zone] for zone in zones]
+        length = max([len(pair) for pair in pairs])
+        heat = np.full((len(zones), length), np.nan)
+        cool = np.full((len(zones), length), np.nan)
+        weights = np.zeros((len(zones), length))
+        for n, pair in enumerate(pairs):
+            heat[n, :len(pair)] = pair.index.get_level_values(0)
+            cool[n, :len(pair)] = pair.index.get_level_values(1)
+            weights[n, :len(pair)] = pair.values
+
+        counts = _comfortband_kernel(heat, cool, [t.astype(self.sp_dtypes[zone]) for zone, t in zip(zones, temps)],
+                                     weights)
+
+        df_comfort = [pd.Series(c, index=t, name=zone) for zone, c, t in zip(zones, counts, temps)]
+
+        return pd.concat(df_comfort, axis=1)
+
+    def get_comfband_stats(self):
+        """Same as get_comfband_stats on the full data"""
+        comfband_counts = join_comfband_counts(self.get_comfortband_counts(), self.temp_hist, self.max_nZones)
+
+        return comfband_counts, self.calculate_temp_1090()
+
+    def get_rm_temp_counts(self):
+        """Same as get_rm_temp_counts on the full data"""
+        return self._get_counts([col for col in self.temp_hist if not col.startswith("off_")])
+
+    def get_off_counts(self):
+        """Same as get_off_counts on the full data"""
+        return self._get_counts([col for col in self.temp_hist if col.startswith("off_")])
+
+    def _get_counts(self, cols):
+        # Only the temperatures that occur, as from value_counts
+        return pd.concat([self.temp_hist[col][self.temp_hist[col] > 0] for col in cols], axis=1)
+
+    def calculate_temp_1090(self):
+        """Same as calculate_temp_1090 on the full data"""
+        output = calculate_temp_1090_hist(self.temp_hist)
+
+        output["start_date"] = self.start_date
+        output["end_date"] = self.end_date
+        return output
+
+def _add_counts(total, counts):
+    # Sum two value_counts series, treating missing values as 0
+    if total is None:
+        return counts
+    return total.add(counts, fill_value=0).astype(np.int64)
+
+class OnlineComfortBand:
+    """
+    Keeps the 10/90 stats of a household up to date as thermostat samples
+    arrive, with the same percentiles as calculate_temp_1090 on all of the
+    samples so far. Only the count of each distinct room temperature is
+    kept, so adding a sample and reading the band take microseconds however
+    long the history is.
+
+    The state can be saved with snapshot (or save) and restored with restore
+    (or load), so a service can restart without replaying the samples.
+
+    Usage:
+        band = OnlineComfortBand(nZones)
+        band.add(timestamp, [rm_temp_0, rm_temp_1], op_mode)
+        rt_10p, rt_90p, rt_off_10p, rt_off_90p = band.get_band(zone)
+    """
+    def __init__(self, nZones):
+        self.nZones = nZones
+        # Sorted distinct room temperatures and their counts, with a column
+        # for each zone's rm_temp_{} then each zone's off_rm_temp_{}
+        self.values = np.array([])
+        self.counts = np.zeros((0, 2*nZones), dtype=np.int64)
+        self.start_date = None
+        self.end_date = None
+
+    def add(self, timestamp, rm_temps, op_mode):
+        """
+        Adds one sample: the room temperature of each zone (NaN if missing)
+        and the op_mode.
+        """
+        is_off = op_mode == "Off"
+        for zone, temp in enumerate(rm_temps):
+            if temp != temp: # NaN
+                continue
+
+            n = np.searchsorted(self.values, temp)
+            if (n == len(self.values)) or (self.values[n] != temp):
+                self.values = np.insert(self.values, n, temp)
+                self.counts = np.insert(self.counts, n, 0, axis=0)
+
+            self.counts[n, zone] += 1
+            if is_off:
+                self.counts[n, self.nZones + zone] += 1
+
+        self._update_dates(timestamp, timestamp)
+
+    def update(self, df):
+        """
+        Adds a batch of samples from a dataframe with Timestamp, rm_temp_{}
+        and op_mode columns, e.g. from import_hvac.
+        """
+        if len(df) == 0:
+            return
+
+        hist = get_temp_hist(df)
+        values = np.union1d(self.values, hist.index.to_numpy(dtype=float))
+        counts = np.zeros((len(values), 2*self.nZones), dtype=np.int64)
+        counts[np.searchsorted(values, self.values)] = self.counts
+
+        rows = np.searchsorted(values, hist.index.to_numpy(dtype=float))
+        for col in hist.columns:
+            zone = int(col.split("_")[-1])
+            n = self.nZones + zone if col.startswith("off_") else zone
+            counts[rows, n] += hist[col].to_numpy()
+
+        self.values = values
+        self.counts = counts
+        self._update_dates(df["Timestamp"].iloc[0], df["Timestamp"].iloc[-1])
+
+    def _update_dates(self, start, end):
+        if self.start_date is None:
+            self.start_date = start
+        self.end_date = end
+
+    def get_band(self, zone):
+        """
+        Returns:
+            (rt_10p, rt_90p, rt_off_10p, rt_off_90p) of the zone, NaN when
+            the zone has no samples
+        """
+        counts = self.counts[:, [zone, self.nZones + zone]]
+        p10 = _quantiles_from_counts(self.values, counts, 0.1)
+        p90 = _quantiles_from_counts(self.values, counts, 0.9)
+        return float(p10[0]), float(p90[0]), float(p10[1]), float(p90[1])
+
+    def calculate_temp_1090(self):
+        """Same as calculate_temp_1090 on all of the samples so far"""
+        p10 = _quantiles_from_counts(self.values, self.counts, 0.1)
+        p90 = _quantiles_from_counts(self.values, self.counts, 0.9)
+
+        output = _temp_1090_frame(range(0, self.nZones), p10, p90)
+        output["start_date"] = self.start_date
+        output["end_date"] = self.end_date
+        return output
+
+    def snapshot(self):
+        """State as a dict of JSON types, see restore"""
+        return {
+                "nZones": self.nZones,
+                "values": self.values.tolist(),
+                "counts": self.counts.tolist(),
+                "start_date": None if self.start_date is None else pd.Timestamp(self.start_date).isoformat(),
+                "end_date": None if self.end_date is None else pd.Timestamp(self.end_date).isoformat()
+        }
+
+    @classmethod
+    def restore(cls, snapshot):
+        """Creates an OnlineComfortBand from a snapshot"""
+        band = cls(snapshot["nZones"])
+        band.values = np.array(snapshot["values"], dtype=float)
+        band.counts = np.array(snapshot["counts"], dtype=np.int64).reshape(-1, 2*band.nZones)
+        if snapshot["start_date"] is not None:
+            band.start_date = pd.Timestamp(snapshot["start_date"])
+            band.end_date = pd.Timestamp(snapshot["end_date"])
+        return band
+
+    def save(self, filepath):
+        snapshot = self.snapshot()
+
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(snapshot, f)
+
+        _atomic_write(filepath, write)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath) as f:
+            return cls.restore(json.load(f))
+
+def find_sp_changes(df, max_nZones, carry=None):
+    """
+    Flags the setpoint changes and room temperature runs of every zone in
+    one pass over the setpoint and room temperature columns. Adds the same
+    columns as find_sp_changes in hvac_comfort_eda.py:
+        {mode}_sp_{}_change: the setpoint differs from the previous row
+        {mode}_sp_{}_man_change: the setpoint changed while hold_on is set
+        rm_temp_{}_counter: number of rows since the room temperature changed
+        rm_temp_{}_times: the room temperature changed on this row
+        is_manual: ts_mode_{} is "Manual", for the last zone with a setpoint
+        change_flag: any setpoint changed on this row
+    The first row is never a change, and a NaN setpoint on either row isn't
+    a change.
+
+    To process the data in segments (months, chunks or shards) with the
+    same results as the whole history at once, pass the carry of the
+    segment before, from get_sp_change_carry. The first row is then
+    compared with the last row of that segment and the run counters carry
+    on from it. See also SPChangeDetector.
+    """
+    sp_cols, rt_cols = _get_sp_change_cols(df, max_nZones)
+    zones = [int(col.split("_")[-1]) for col in rt_cols]
+
+    sp = df[sp_cols].to_numpy(dtype=float)
+    rt = df[rt_cols].to_numpy(dtype=float)
+    hold_on = df["hold_on"].fillna(False).to_numpy(dtype=bool) # a missing hold status is not a hold
+
+    change, starts, counter = _sp_change_arrays(sp, rt, sp_cols, rt_cols, carry)
+    man_change = change & hold_on[:, None]
+
+    # Added in the column order of the eda version
+    new_cols = {}
+    for n, sp_col in enumerate(sp_cols):
+        zone = int(sp_col.split("_")[-1])
+        rt_col = "rm_temp_{}".format(zone)
+        new_cols[sp_col + "_change"] = change[:, n]
+        new_cols["is_manual"] = None
+        new_cols[sp_col + "_man_change"] = man_change[:, n]
+        new_cols[rt_col + "_counter"] = counter[:, zones.index(zone)]
+        new_cols[rt_col + "_times"] = starts[:, zones.index(zone)]
+
+    if sp_cols:
+        last_zone = int(sp_cols[-1].split("_")[-1])
+        new_cols["is_manual"] = (df["ts_mode_{}".format(last_zone)] == "Manual").to_numpy()
+
+    # Replace columns from an earlier call in place, add the rest together
+    df = df.copy()
+    for col in [col for col in new_cols if col in df]:
+        df[col] = new_cols.pop(col)
+    df = pd.concat([df, pd.DataFrame(new_cols, index=df.index)], axis=1)
+
+    change_cols = [col for col in df.columns if ("_change" in col) & ("_man" not in col)]
+    df["change_flag"] = np.nansum(df[change_cols].to_numpy(dtype=float), axis=1) != 0
+
+    return df
+
+def get_sp_change_carry(df, max_nZones, carry=None):
+    """
+    The state find_sp_changes needs to continue after the segment df: the
+    last setpoints and room temperatures, and the number of rows the last
+    room temperature run has lasted. carry is the state from before df,
+    since a run can span several segments. Only the setpoint and room
+    temperature columns are used, so the carry of each segment can be found
+    in a quick first pass before the segments are flagged in parallel. The
+    hold status isn't needed, since a change is flagged with the hold_on of
+    the row it happens on.
+    Returns:
+        carry: dict of JSON types with "sp", "rm_temp" and "counter" dicts
+            by column name
+    """
+    if len(df) == 0:
+        return carry
+
+    sp_cols, rt_cols = _get_sp_change_cols(df, max_nZones)
+    rt = df[rt_cols].to_numpy(dtype=float)
+    _, _, counter = _sp_change_arrays(np.zeros((len(df), 0)), rt, [], rt_cols, carry)
+
+    last = df.iloc[-1]
+    return {
+            "sp": {col: float(last[col]) for col in sp_cols},
+            "rm_temp": {col: float(last[col]) for col in rt_cols},
+            "counter": {col: int(c) for col, c in zip(rt_cols, counter[-1])}
+    }
+
+def _get_sp_change_cols(df, max_nZones):
+    # Setpoint columns in the order of the eda loops, and the room
+    # temperature columns of their zones
+    sp_cols = ["{}_sp_{}".format(mode, zone) for mode in ["heat", "cool"] for zone in range(0, max_nZones)]
+    sp_cols = [col for col in sp_cols if col in df]
+    zones = sorted(set(int(col.split("_")[-1]) for col in sp_cols))
+    return sp_cols, ["rm_temp_{}".format(zone) for zone in zones]
+
+def _sp_change_arrays(sp, rt, sp_cols, rt_cols, carry=None):
+    # Change flags, run starts and run counters, with the carry (if any) as
+    # the row before the first. Columns missing from the carry are NaN.
+    carry = carry or {"sp": {}, "rm_temp": {}, "counter": {}}
+    prev_sp = np.array([carry["sp"].get(col, np.nan) for col in sp_cols], dtype=float)
+    prev_rt = np.array([carry["rm_temp"].get(col, np.nan) for col in rt_cols], dtype=float)
+    prev_counter = np.array([carry["counter"].get(col, 0) for col in rt_cols], dtype=np.int64)
+
+    sp = np.vstack([prev_sp[None, :], sp])
+    change = (sp[1:] != sp[:-1]) & ~np.isnan(sp[1:]) & ~np.isnan(sp[:-1])
+
+    # A room temperature run starts where the value differs from the row
+    # before, including NaNs, and counts up until the next start
+    rt = np.vstack([prev_rt[None, :], rt])
+    starts = ~(rt[1:] == rt[:-1])
+    rows = np.arange(len(starts))[:, None]
+    counter = rows - np.maximum.accumulate(np.where(starts, rows, -(prev_counter + 1)), axis=0)
+
+    return change, starts, counter
+
+class SPChangeDetector:
+    """
+    Runs find_sp_changes over consecutive segments of a household's data,
+    e.g. monthly files or chunks from import_hvac_chunks, carrying the state
+    between them so the flags are the same as for the whole history at once.
+
+    Usage:
+        detector = SPChangeDetector(max_nZones)
+        for chunk in chunks:
+            df = detector.update(chunk)
+    """
+    def __init__(self, max_nZones, carry=None):
+        self.max_nZones = max_nZones
+        self.carry = carry
+
+    def update(self, df):
+        flagged = find_sp_changes(df, self.max_nZones, self.carry)
+        self.carry = get_sp_change_carry(df, self.max_nZones, self.carry)
+        return flagged
+
+def count_sp_changes(df, zone_num):
+    """
+    Counts, at each room temperature of a zone, the manual heating and
+    cooling setpoint changes, the room temperature runs and the rows, from
+    the columns added by find_sp_changes. Same as count_sp_changes in
+    hvac_comfort_eda.py, with bincounts in place of a groupby and join.
+    Returns:
+        df_counts: dataframe indexed by room temperature with columns
+            heat_sp_{}_man_change, cool_sp_{}_man_change, rm_temp_{}_times,
+            rm_temp_{} (number of rows) and the _norm columns, the change
+            counts divided by the number of rows
+    """
+    rt_col = "rm_temp_{}".format(zone_num)
+    hsp_col = "heat_sp_{}_man_change".format(zone_num)
+    csp_col = "cool_sp_{}_man_change".format(zone_num)
+    rt_count_col = rt_col + "_times"
+
+    values, bins = _bin_temps(df[rt_col].to_numpy(dtype=float))
+    valid = df[rt_col].notna().to_numpy()
+    bins = bins[valid]
+
+    df_counts = pd.DataFrame(index=pd.Index(values, name=rt_col))
+    for col in [hsp_col, csp_col, rt_count_col]:
+        weights = df[col].to_numpy(dtype=np.int64)[valid]
+        df_counts[col] = np.bincount(bins, weights, minlength=len(values)).astype(np.int64)
+    df_counts[rt_col] = np.bincount(bins, minlength=len(values))
+
+    df_counts[hsp_col+"_norm"] = df_counts[hsp_col]/df_counts[rt_col]
+    df_counts[csp_col+"_norm"] = df_counts[csp_col]/df_counts[rt_col]
+
+    return df_counts
+
+class AsyncWriter:
+    """
+    Runs output jobs, such as plotting, in background worker processes so
+    the caller can go on to the next calculation.
+
+    At most max_pending jobs are queued or running at once; submit blocks
+    until a job finishes beyond that, which bounds the memory held by the
+    job arguments. Job errors don't stop the caller and are raised by close.
+    """
+    def __init__(self, workers=1, max_pending=2):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def submit(self, func, *args):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        """
+        Waits for all jobs to finish and returns their results in submission
+        order. If any job failed, raises a RuntimeError with the number of
+        failed jobs, caused by the first job error.
+        """
+        self.pool.shutdown(wait=True)
+
+        errors = [future.exception() for future in self.futures if future.exception() is not None]
+        if errors:
+            raise RuntimeError("{} of {} background jobs failed".format(len(errors), len(self.futures))) from errors[0]
+
+        return [future.result() for future in self.futures]
+
+def plot_comfband_bars(df, savepath, fig_title, include_plotlyjs=True):
+    """
+    Plots bar chart for the counts of each setpoint within the comfortband
+
+    include_plotlyjs is passed to plotly: True embeds plotly.js in the file,
+    "directory" references a single plotly.min.js next to the subplots
+    instead, which keeps each subplot a few KB.
+    """
+    # Imported here so runs without plots don't pay for loading plotly
+    import plotly.offline as pyo
+    import plotly.graph_objs as go
+
+    data = [go.Bar(x=df.index, y=df[col], name=label) for label, col in _get_bar_series(df)]
 
     layout = go.Layout(
             title = fig_title,
@@ -211,5 +2096,206 @@ def plot_comfband_bars(df, savepath, fig_title):
     )
 
     fig = go.Figure(data=data, layout=layout)
-    pyo.plot(fig, filename = savepath, auto_open=False)
+    pyo.plot(fig, filename = savepath, auto_open=False, include_plotlyjs=include_plotlyjs)
     return
+
+def _get_bar_series(df):
+    """
+    Returns the (label, column) of each bar plotted from a comfortband
+    counts frame, which are the off counts of each zone.
+    """
+    series = []
+    for col in df:
+        if type(col) == int or "norm" in col:
+            continue
+        elif "off_rm_temp" in col:
+            series.append(("Z{} Off Counts".format(col.split("_")[-1]), col))
+
+    return series
+
+def get_report_data(comfband_counts):
+    """
+    Compacts the bars plotted by plot_comfband_bars for the report page.
+    Temperatures without counts in any bar are left out, as their bars are
+    empty.
+    Returns:
+        data: dict of the "temps" and the "bars", a list of name and counts
+    """
+    series = _get_bar_series(comfband_counts)
+    counts = comfband_counts[[col for label, col in series]]
+    keep = (counts.fillna(0) != 0).any(axis=1).values
+
+    return {
+        "temps": [_json_number(x) for x in comfband_counts.index[keep]],
+        "bars": [{"name": label, "counts": [_json_number(x) for x in counts[col].values[keep]]}
+                 for label, col in series]
+    }
+
+def _json_number(x):
+    """Converts a count or temperature to int, float, or None for NaN"""
+    x = float(x)
+    if np.isnan(x):
+        return None
+
+    return int(x) if x.is_integer() else x
+
+def save_report_data(filepath, rlid, months):
+    """
+    Saves the report data of a household, for each (month, comfband_counts)
+    in months, as a script for the page from write_report_page. The data is
+    JSON, wrapped in a call so the page can load it from disk without a web
+    server.
+    """
+    data = {"rlid": rlid, "months": {month: get_report_data(counts) for month, counts in months}}
+    with open(filepath, "w") as f:
+        f.write("comfbandReport.add({});\n".format(json.dumps(data, separators=(",", ":"))))
+
+def write_report_page(filepath, households):
+    """
+    Writes the report page, which loads the data of the households and
+    renders their comfort band plots as they are paged to, filtered by RLID
+    and month.
+
+    households is a list of (rlid, filepath from save_report_data, months).
+    One plotly.min.js is written next to the first household's data, where
+    the "shared" Plot Output also keeps it.
+    """
+    # Imported here so runs without plots don't pay for loading plotly
+    from plotly.offline import get_plotlyjs
+
+    page_dir = os.path.dirname(os.path.abspath(filepath))
+    relpath = lambda path: os.path.relpath(os.path.abspath(path), page_dir).replace(os.sep, "/")
+
+    data_dir = os.path.dirname(households[0][1]) if households else os.path.dirname(filepath)
+    plotlyjs_path = os.path.join(data_dir, "plotly.min.js")
+    if not os.path.exists(plotlyjs_path):
+        with open(plotlyjs_path, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+
+    index = [{"rlid": rlid, "src": relpath(path), "months": list(months)} for rlid, path, months in households]
+    page = REPORT_PAGE.replace("__PLOTLYJS__", relpath(plotlyjs_path))
+    page = page.replace("__INDEX__", json.dumps(index, separators=(",", ":")))
+    with open(filepath, "w") as f:
+        f.write(page)
+
+# Report page of write_report_page. Household data scripts are only loaded
+# for the plots on the current page.
+REPORT_PAGE = """<html>
+<head>
+<meta charset="utf-8">
+<script src="__PLOTLYJS__"></script>
+<style>
+body { font-family: sans-serif; }
+#controls { position: sticky; top: 0; background: white; padding: 8px 0; z-index: 10; }
+.plot { width: 100%; height: 400px; }
+</style>
+</head>
+<body>
+<div id="controls">
+RLID <input id="rlid" list="rlids" size="12">
+Month <input id="month" list="months" size="12">
+Per page <select id="size"><option>5</option><option selected>10</option><option>25</option><option>50</option></select>
+<button id="prev">&lt;</button> <span id="status"></span> <button id="next">&gt;</button>
+<datalist id="rlids"></datalist><datalist id="months"></datalist>
+</div>
+<div id="plots"></div>
+<script>
+var comfbandReport = (function () {
+    var index = __INDEX__;
+    var loaded = {}, waiting = {}, figures = [], page = 0, rendering = 0;
+    var el = function (id) { return document.getElementById(id); };
+
+    function options(id, values) {
+        var seen = {};
+        values.forEach(function (value) {
+            if (seen[value]) { return; }
+            seen[value] = true;
+            var option = document.createElement("option");
+            option.value = value;
+            el(id).appendChild(option);
+        });
+    }
+
+    function load(household, callback) {
+        if (loaded[household.rlid]) { return callback(loaded[household.rlid]); }
+        if (!waiting[household.rlid]) {
+            waiting[household.rlid] = [];
+            var script = document.createElement("script");
+            script.src = household.src;
+            document.head.appendChild(script);
+        }
+        waiting[household.rlid].push(callback);
+    }
+
+    function add(data) {
+        loaded[data.rlid] = data;
+        (waiting[data.rlid] || []).forEach(function (callback) { callback(data); });
+        delete waiting[data.rlid];
+    }
+
+    function plot(div, data, month) {
+        var counts = data.months[month];
+        var traces = counts.bars.map(function (bar) {
+            return {type: "bar", x: counts.temps, y: bar.counts, name: bar.name};
+        });
+        Plotly.newPlot(div, traces, {
+            title: {text: data.rlid + ": " + month},
+            yaxis: {title: {text: "Number of Timesteps"}},
+            xaxis: {title: {text: "Room Temperature [deg F]"}, range: [60, 80]},
+            boxmode: "group"
+        });
+    }
+
+    function filter() {
+        var rlid = el("rlid").value.trim().toLowerCase();
+        var month = el("month").value.trim().toLowerCase();
+        figures = [];
+        index.forEach(function (household) {
+            if (household.rlid.toLowerCase().indexOf(rlid) < 0) { return; }
+            household.months.forEach(function (m) {
+                if (m.toLowerCase().indexOf(month) >= 0) { figures.push([household, m]); }
+            });
+        });
+        page = 0;
+        render();
+    }
+
+    function render() {
+        var size = parseInt(el("size").value, 10);
+        var pages = Math.max(Math.ceil(figures.length / size), 1);
+        page = Math.min(Math.max(page, 0), pages - 1);
+        el("status").textContent = "Page " + (page + 1) + " of " + pages + " (" + figures.length + " plots)";
+
+        var plots = el("plots");
+        Array.prototype.forEach.call(plots.children, function (div) { Plotly.purge(div); });
+        plots.innerHTML = "";
+
+        // Plots of a page that has since been left are not drawn
+        var current = ++rendering;
+        figures.slice(page*size, (page + 1)*size).forEach(function (figure) {
+            var div = document.createElement("div");
+            div.className = "plot";
+            plots.appendChild(div);
+            load(figure[0], function (data) {
+                if (current === rendering) { plot(div, data, figure[1]); }
+            });
+        });
+    }
+
+    window.addEventListener("load", function () {
+        options("rlids", index.map(function (household) { return household.rlid; }));
+        options("months", [].concat.apply([], index.map(function (household) { return household.months; })));
+        el("rlid").addEventListener("input", filter);
+        el("month").addEventListener("input", filter);
+        el("size").addEventListener("change", function () { page = 0; render(); });
+        el("prev").addEventListener("click", function () { page -= 1; render(); });
+        el("next").addEventListener("click", function () { page += 1; render(); });
+        filter();
+    });
+
+    return {add: add};
+})();
+</script>
+</body>
+</html>
+"""
@@ -3,6 +3,10 @@
 Created on Mon Jun 24 16:26:20 2019
 
 @author: pcsh009
+
+Note: hvac_comfort_calc.py can read a season directly from the monthly files
+with a range of months in the config "Months" row (e.g. "2018-09 to 2018-11"),
+so this merged copy is only needed for other tools.
 """
 
 import os 
@@ -18,20 +22,15 @@ file_out_pattern = "RL{}_hvac_season4.csv"
 for rlid in rlids: 
     print("RLID: {}".format(rlid))
     #for filename in os.listdir(dir_in): 
+    dfs = []
     for month in autumn_months: 
         filepath = "{}RL{}_hvac_{}.csv".format(dir_in, rlid, month)
 
-        
-        df = pd.read_csv(filepath) 
-        
-        if "df_concat" not in globals(): 
-            df_concat = df 
-        else: 
-            df_concat = pd.concat([df_concat, df]) 
-            
-    file_out = file_out_pattern.format(rlid)
-    df_concat.to_csv(dir_in + file_out, index=False) 
-    del df_concat 
-        
+        dfs.append(pd.read_csv(filepath))
 
+    # Concatenate once, copying each month a single time
+    df_concat = pd.concat(dfs)
 
+    file_out = file_out_pattern.format(rlid)
+    df_concat.to_csv(dir_in + file_out, index=False) 
+    del df_concat, dfs
\ No newline at end of file